@@ -0,0 +1,400 @@
+"""
+Flask-Goat benchmarks
+---------------------
+
+Measures protected-view throughput and latency, and login-to-callback
+latency, against a local stub of the GitHub API. Nothing leaves the host.
+Run it from a checkout with Flask-Goat installed (`pip install -e .`):
+
+    python benchmarks/bench.py --output head.json
+    python benchmarks/bench.py compare base.json head.json
+
+Scenarios:
+
+cold      no decision caching; every check asks the stub
+warm      decisions and team sets cached and pre-warmed
+storm     warm caches expired all at once, then hit by every user together
+callback  /login followed by /callback for each user
+"""
+
+import re
+import sys
+import json
+import time
+import argparse
+import platform
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+from flask import Flask
+from flask_goat import Goat
+
+clock = getattr(time, 'perf_counter', time.time)
+
+ORG = 'organization'
+
+
+def is_member(user, tid):
+    """Deterministic membership: user N is on every team but those with
+    (N + id) divisible by three.
+    """
+
+    return (int(user[len('user'):]) + tid) % 3 != 0
+
+
+class StubGitHub(ThreadingMixIn, HTTPServer):
+
+    """The GitHub endpoints Goat calls, each answering after `latency`
+    seconds.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency, teams):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.latency = latency
+        self.teams = teams
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def count(self):
+        with self._lock:
+            self.calls += 1
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # headers and body go out in separate writes; without TCP_NODELAY a
+    # keep-alive call stalls on delayed ACKs for tens of milliseconds
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _user(self, query):
+        token = query.get('access_token', [''])[0] or \
+            self.headers.get('Authorization', '').split(' ')[-1]
+        return token[len('token-'):]
+
+    def _reply(self, status, body=None):
+        data = json.dumps(body).encode('utf-8') if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _route(self):
+        self.server.count()
+        time.sleep(self.server.latency)
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        parts = url.path.strip('/').split('/')
+        teams = [{'name': 'team{}'.format(t), 'id': t,
+                  'organization': {'login': ORG}}
+                 for t in range(1, self.server.teams + 1)]
+        if parts == ['login', 'oauth', 'access_token']:
+            return self._reply(200, {
+                'access_token': 'token-' + query['code'][0]})
+        if parts == ['user']:
+            return self._reply(200, {'login': self._user(query)})
+        if parts == ['user', 'teams']:
+            user = self._user(query)
+            return self._reply(200, [
+                t for t in teams if is_member(user, t['id'])])
+        if parts[0] == 'orgs' and parts[2:] == ['teams']:
+            return self._reply(200, teams)
+        if parts[0] == 'orgs' and parts[2] == 'members':
+            return self._reply(204)
+        if parts[0] == 'teams' and parts[2] == 'memberships':
+            member = is_member(parts[3], int(parts[1]))
+            return self._reply(200 if member else 404, {})
+        return self._reply(404, {})
+
+    do_GET = _route
+    do_POST = _route
+
+
+def build_app(args, config):
+    app = Flask('bench')
+    app.secret_key = 'bench'
+    app.config.update({
+        'GOAT_CLIENT_ID': 'bench',
+        'GOAT_CLIENT_SECRET': 'bench',
+        'GOAT_ORGANIZATION': ORG,
+        'GOAT_CALLBACK': 'http://localhost/callback',
+        'GOAT_WORKERS': args.workers,
+    })
+    if args.redis:
+        host, _, port = args.redis.partition(':')
+        app.config['GOAT_STORAGE'] = {'backend': 'redis'}
+        app.config['GOAT_REDIS'] = {
+            'method': 'tcp', 'host': host, 'port': int(port or 6379),
+            'db': args.redis_db}
+    else:
+        app.config['GOAT_STORAGE'] = {'backend': 'memory'}
+    app.config.update(config)
+    goat = Goat(app)
+
+    teams = ['team{}'.format(t) for t in range(1, args.teams + 1)]
+
+    @app.route('/')
+    def index():
+        return 'index'
+
+    @app.route('/all')
+    @goat.members_only(*teams[:2])
+    def all_teams():
+        return 'ok'
+
+    @app.route('/any')
+    @goat.members_union(*teams)
+    def any_team():
+        return 'ok'
+
+    return app, goat
+
+
+def expire(app, goat, users):
+    """Drops every cached decision, team set and the team map marker.
+    """
+
+    with app.app_context():
+        for user in users:
+            goat.invalidate_membership(user)
+    goat.storage.delete(['GOAT_TEAMS_REFRESH'])
+    if goat.local_cache is not None:
+        goat.local_cache.clear()
+
+
+def reset(app, goat, users):
+    expire(app, goat, users)
+    goat.storage.delete(['GOAT_TEAMS', 'GOAT_TEAMS_PAGES'] +
+                        [goat._user_key(u) for u in users])
+
+
+def login(app, goat, users):
+    """Stores a token per user and returns a session cookie for each.
+    """
+
+    serializer = app.session_interface.get_signing_serializer(app)
+    with app.app_context():
+        goat.storage.set_many([
+            goat._user_write(u, goat._new_user_record('token-' + u))
+            for u in users])
+    return dict((u, serializer.dumps({'user': u})) for u in users)
+
+
+def run(app, jobs, concurrency, request):
+    """Runs the jobs on `concurrency` threads; returns the latencies and
+    the wall time.
+    """
+
+    local = threading.local()
+
+    def timed(job):
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = app.test_client(use_cookies=False)
+        start = clock()
+        request(client, job)
+        return clock() - start
+
+    start = clock()
+    with ThreadPoolExecutor(concurrency) as pool:
+        latencies = list(pool.map(timed, jobs))
+    return latencies, clock() - start
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[int(round(p / 100.0 * (len(values) - 1)))]
+
+
+def summarize(scenario, view, latencies, wall, calls):
+    return {
+        'scenario': scenario,
+        'view': view,
+        'requests': len(latencies),
+        'rps': round(len(latencies) / wall, 2),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'github_calls': calls,
+    }
+
+
+def bench_views(args, stub, scenario):
+    cached = scenario != 'cold'
+    ttl = 300 if cached else 0
+    app, goat = build_app(args, {
+        'GOAT_MEMBERSHIP_TTL': ttl,
+        'GOAT_MEMBERSHIP_NEGATIVE_TTL': ttl,
+        'GOAT_USER_TEAMS_TTL': ttl,
+    })
+    users = ['user{}'.format(i) for i in range(args.users)]
+    reset(app, goat, users)
+    cookies = login(app, goat, users)
+
+    def request(client, job):
+        user, view = job
+        client.get(view, headers={
+            'Cookie': 'session={}'.format(cookies[user])})
+
+    results = []
+    for view in ('/all', '/any'):
+        jobs = [(u, view) for u in users]
+        if cached:
+            run(app, jobs, args.concurrency, request)
+        if scenario == 'storm':
+            expire(app, goat, users)
+        else:
+            jobs = jobs * args.rounds
+        calls = stub.calls
+        latencies, wall = run(app, jobs, args.concurrency, request)
+        results.append(summarize(
+            scenario, view, latencies, wall, stub.calls - calls))
+    reset(app, goat, users)
+    return results
+
+
+def bench_callback(args, stub):
+    app, goat = build_app(args, {})
+    users = ['user{}'.format(i) for i in range(args.users)]
+    reset(app, goat, users)
+    state = re.compile(r'state=([^&"]+)')
+
+    def request(client, user):
+        page = client.get('/login').get_data(as_text=True)
+        resp = client.get('/callback?state={}&code={}'.format(
+            state.search(page).group(1), user))
+        assert resp.status_code == 302, resp.status_code
+
+    calls = stub.calls
+    latencies, wall = run(app, users, args.concurrency, request)
+    reset(app, goat, users)
+    return [summarize('callback', '/callback', latencies, wall,
+                      stub.calls - calls)]
+
+
+def commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.STDOUT).decode('utf-8').strip()
+    except Exception:
+        return None
+
+
+def bench(args):
+    stub = StubGitHub(args.latency / 1000.0, args.teams)
+    stub.start()
+    Goat.API = stub.url
+    Goat.OAUTH = stub.url + '/login/oauth'
+
+    results = []
+    for scenario in args.scenarios:
+        if scenario == 'callback':
+            results.extend(bench_callback(args, stub))
+        else:
+            results.extend(bench_views(args, stub, scenario))
+    stub.shutdown()
+
+    report = {
+        'commit': commit(),
+        'python': platform.python_version(),
+        'storage': 'redis' if args.redis else 'memory',
+        'config': {
+            'users': args.users,
+            'teams': args.teams,
+            'rounds': args.rounds,
+            'concurrency': args.concurrency,
+            'workers': args.workers,
+            'latency_ms': args.latency,
+        },
+        'results': results,
+    }
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(data + '\n')
+    print(data)
+
+
+def compare(args):
+    """Prints the change of every metric from the base to the head run.
+    """
+
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.head) as f:
+        head = json.load(f)
+    before = dict(((r['scenario'], r['view']), r) for r in base['results'])
+    print('{:<10} {:<10} {:>10} {:>10} {:>10} {:>8}'.format(
+        'scenario', 'view', 'rps', 'p50_ms', 'p99_ms', 'calls'))
+    for r in head['results']:
+        old = before.get((r['scenario'], r['view']))
+        if old is None:
+            continue
+        changes = []
+        for key in ('rps', 'p50_ms', 'p99_ms'):
+            delta = (r[key] - old[key]) / old[key] * 100 if old[key] else 0
+            changes.append('{:+.1f}%'.format(delta))
+        changes.append('{:+d}'.format(r['github_calls'] - old['github_calls']))
+        print('{:<10} {:<10} {:>10} {:>10} {:>10} {:>8}'.format(
+            r['scenario'], r['view'], *changes))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[4])
+    sub = parser.add_subparsers(dest='command')
+    cmp_parser = sub.add_parser('compare', help='compare two reports')
+    cmp_parser.add_argument('base')
+    cmp_parser.add_argument('head')
+
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--teams', type=int, default=3)
+    parser.add_argument('--rounds', type=int, default=5,
+                        help='requests per user and view')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--workers', type=int, default=8,
+                        help='GOAT_WORKERS')
+    parser.add_argument('--latency', type=float, default=20,
+                        help='stub GitHub latency in milliseconds')
+    parser.add_argument('--redis', metavar='HOST[:PORT]',
+                        help='use Redis instead of in-memory storage')
+    parser.add_argument('--redis-db', type=int, default=15)
+    parser.add_argument('--scenarios', nargs='+',
+                        default=['cold', 'warm', 'storm', 'callback'],
+                        choices=['cold', 'warm', 'storm', 'callback'])
+    parser.add_argument('--output', help='also write the report here')
+
+    args = parser.parse_args(argv)
+    if args.command == 'compare':
+        compare(args)
+    else:
+        bench(args)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
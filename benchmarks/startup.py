@@ -0,0 +1,89 @@
+"""
+Flask-Goat startup benchmark
+----------------------------
+
+Measures what a worker pays before it serves its first request: the time
+to import Flask-Goat on top of Flask, the packages that import pulls in,
+and the time `Goat(app)` takes with each storage backend. Every sample
+runs in a fresh interpreter, and nothing connects anywhere:
+
+    python benchmarks/startup.py --output head.json
+"""
+
+import sys
+import json
+import argparse
+import platform
+import subprocess
+
+SAMPLE = r'''
+import sys, time, json
+clock = getattr(time, 'perf_counter', time.time)
+import flask
+before = set(sys.modules)
+start = clock()
+from flask_goat import Goat
+imported = clock() - start
+app = flask.Flask('startup')
+app.config.update({
+    'GOAT_CLIENT_ID': 'startup',
+    'GOAT_CLIENT_SECRET': 'startup',
+    'GOAT_ORGANIZATION': 'organization',
+    'GOAT_CALLBACK': 'http://localhost/callback',
+    'GOAT_STORAGE': {'backend': %r},
+})
+start = clock()
+Goat(app)
+initialized = clock() - start
+print(json.dumps({
+    'import': imported,
+    'init_app': initialized,
+    'packages': sorted(set(m.split('.')[0] for m in set(sys.modules) - before
+                           if '.' in m or m[0] != '_')),
+}))
+'''
+
+
+def sample(backend):
+    out = subprocess.check_output([sys.executable, '-c', SAMPLE % backend])
+    return json.loads(out.decode('utf-8'))
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[4])
+    parser.add_argument('--runs', type=int, default=20,
+                        help='fresh interpreters per backend')
+    parser.add_argument('--output', help='also write the report here')
+    args = parser.parse_args(argv)
+
+    results = []
+    for backend in ('redis', 'memory'):
+        samples = [sample(backend) for _ in range(args.runs)]
+        results.append({
+            'storage': backend,
+            'import_ms': round(median([s['import'] for s in samples])
+                               * 1000, 3),
+            'init_app_ms': round(median([s['init_app'] for s in samples])
+                                 * 1000, 3),
+            'packages': samples[-1]['packages'],
+        })
+
+    report = {
+        'python': platform.python_version(),
+        'runs': args.runs,
+        'results': results,
+    }
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(data + '\n')
+    print(data)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,11 +1,22 @@
 import os
-import requests
-import redis
+import hmac
+import time
+import hashlib
+import threading
 import simplejson as json
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from functools import wraps
+from itsdangerous import URLSafeTimedSerializer, BadSignature
 from uuid import uuid4
 from flask import current_app, request, abort, session,\
-    redirect, url_for, render_template
+    redirect, url_for, render_template, g, has_app_context
+from .cache import LRUCache, SingleFlight
+from .breaker import CircuitBreaker, CircuitOpen, GitHubUnavailable
+from .client import HTTPClient
+from .policy import Policy, Team, CompiledPolicy
+from .metrics import Metrics, NullMetrics, MeteredStorage, endpoint
+from .storage import Storage, RedisStorage, MemoryStorage, SQLiteStorage
+from .trace import Trace, TracingMetrics, request_traced, current_trace
 
 try:
     from urllib import urlencode
@@ -13,6 +24,11 @@ try:
 except:
     from urllib.parse import urlencode, urlparse
 
+__all__ = [
+    'Goat', 'Policy', 'Team', 'GitHubUnavailable', 'CircuitOpen',
+    'request_traced',
+]
+
 
 class Goat(object):
 
@@ -22,11 +38,60 @@ class Goat(object):
     OAUTH = 'https://github.com/login/oauth'
     API = 'https://api.github.com'
     REFRESH_TEAMS = 86400
+    INVALIDATE_CHANNEL = 'GOAT_INVALIDATE'
+    RATE_LIMIT_SYNC = 30
+    COALESCE_POLL = 0.05
+    USER_TOUCH = 0.1
+    HOT_PREFIX = 'GOAT_HOT:'
+    REFRESH_AHEAD = {
+        'interval': 60,
+        'margin': 300,
+        'stale': 900,
+    }
+    SIGNED_STATE = {
+        'max_age': 1000,
+        'replay': False,
+    }
 
     DEFAULTS = {
         'GOAT_CLIENT_ID': os.getenv('GOAT_CLIENT_ID'),
         'GOAT_CLIENT_SECRET': os.getenv('GOAT_CLIENT_SECRET'),
         'GOAT_SCOPE': 'read:org',
+        'GOAT_MEMBERSHIP_TTL': 0,
+        'GOAT_MEMBERSHIP_NEGATIVE_TTL': 0,
+        'GOAT_USER_TEAMS_TTL': 0,
+        'GOAT_USER_TTL': 30 * 86400,
+        'GOAT_CLAIM_TTL': 0,
+        'GOAT_GRAPHQL': False,
+        'GOAT_SIGNED_STATE': None,
+        'GOAT_GRACE': 3600,
+        'GOAT_RATELIMIT_RESERVE': 0,
+        'GOAT_COALESCE': {
+            'lock': 10,
+            'wait': 5,
+        },
+        'GOAT_LOCAL_CACHE': None,
+        'GOAT_WORKERS': 8,
+        'GOAT_REFRESH_AHEAD': None,
+        'GOAT_WEBHOOK': None,
+        'GOAT_METRICS': None,
+        'GOAT_TRACE': False,
+        'GOAT_BREAKER': {
+            'failures': 5,
+            'reset': 30,
+            'probes': 1,
+        },
+        'GOAT_WEBHOOK_SECRET': os.getenv('GOAT_WEBHOOK_SECRET'),
+        'GOAT_STORAGE': {
+            'backend': 'redis',
+        },
+        'GOAT_HTTP': {
+            'pool_size': 10,
+            'connect_timeout': 3.05,
+            'read_timeout': 10,
+            'retries': 3,
+            'backoff': 0.3,
+        },
         'GOAT_REDIS': {
             'method': 'tcp',
             'host': 'localhost',
@@ -35,6 +100,18 @@ class Goat(object):
         }
     }
 
+    GRAPHQL_LOGIN = """query($org: String!) {
+  viewer { login organization(login: $org) { viewerIsAMember } }
+}"""
+    GRAPHQL_TEAMS = """query($org: String!, $login: String!, $after: String) {
+  organization(login: $org) {
+    teams(first: 100, userLogins: [$login], after: $after) {
+      nodes { databaseId }
+      pageInfo { hasNextPage endCursor }
+    }
+  }
+}"""
+
     LOGIN = """<html lang="en">
 <head>
 <title>{org}</title>
@@ -52,11 +129,29 @@ class Goat(object):
 </html>"""
 
     def __init__(self, app):
+        self.cache_stats = {'hits': 0, 'misses': 0}
+        self.metrics = NullMetrics()
+        self.breaker = None
+        self.local_cache = None
+        self._executor = None
+        self._executor_pid = None
+        self._executor_lock = threading.Lock()
+        self.refresh_ahead = None
+        self._refresher_pid = None
+        self._hot = None
+        self._pid = None
+        self._node = str(uuid4())
+        # budgets per token digest, trusted for RATE_LIMIT_SYNC seconds
+        self._rate_limits = LRUCache(maxsize=10000, ttl=Goat.RATE_LIMIT_SYNC)
+        self._rate_limits_written = LRUCache(maxsize=10000,
+                                             ttl=Goat.RATE_LIMIT_SYNC)
+        self._flights = SingleFlight()
         if app is not None:
             self.init_app(app)
 
     def init_app(self, app):
-        """Sets up callback and establishes Redis connection.
+        """Sets up callback and storage. Connections are opened on first
+        use in each process.
         """
 
         for var in Goat.DEFAULTS:
@@ -72,29 +167,571 @@ class Goat(object):
         app.add_url_rule(u.path, view_func=self._callback)
         app.add_url_rule('/login', 'login', view_func=self._login)
         app.add_url_rule('/logout', 'logout', view_func=self._logout)
-        self.redis_connection = self._connect(app)
 
-    def _connect(self, app):
-        params = app.config.get('GOAT_REDIS')
+        webhook = app.config.get('GOAT_WEBHOOK')
+        if webhook is not None:
+            assert app.config.get('GOAT_WEBHOOK_SECRET') is not None
+            app.add_url_rule(webhook, 'goat_webhook',
+                             view_func=self._webhook, methods=['POST'])
+
+        metrics = app.config.get('GOAT_METRICS')
+        if metrics:
+            self.metrics = Metrics(metrics.get('buckets'))
+            if metrics.get('endpoint'):
+                app.add_url_rule(metrics['endpoint'], 'goat_metrics',
+                                 view_func=self._metrics_view)
+
+        if app.config.get('GOAT_TRACE'):
+            self.metrics = TracingMetrics(self.metrics)
+            app.before_request(self._start_trace)
+            app.after_request(self._finish_trace)
+
+        self.storage = self._open_storage(app)
+        if not isinstance(self.metrics, NullMetrics):
+            self.storage = MeteredStorage(self.storage, self.metrics)
+
+        self.workers = app.config.get('GOAT_WORKERS')
+
+        self.http = HTTPClient(**self._http_params(app))
+
+        breaker = app.config.get('GOAT_BREAKER')
+        if breaker:
+            self.breaker = CircuitBreaker(
+                listener=self._breaker_changed, **breaker)
+            self.metrics.set('goat_breaker_state', 0)
+
+        local = app.config.get('GOAT_LOCAL_CACHE')
+        if local:
+            self.local_cache = LRUCache(**local)
+        app.before_request(self._ensure_process)
+
+        if getattr(app, 'cli', None) is not None:
+            app.cli.command('goat-sweep')(self._sweep_command)
+
+        ahead = app.config.get('GOAT_REFRESH_AHEAD')
+        if ahead:
+            self.refresh_ahead = dict(Goat.REFRESH_AHEAD, **ahead)
+            self._hot = LRUCache(maxsize=10000,
+                                 ttl=self.refresh_ahead['margin'])
+            app.before_request(self._ensure_refresher)
+
+    def _open_storage(self, app):
+        params = app.config.get('GOAT_STORAGE')
+        if isinstance(params, Storage):
+            return params
+        options = dict((k, v) for k, v in params.items() if k != 'backend')
+        if params['backend'] == 'redis':
+            params = app.config.get('GOAT_REDIS')
+            if params['method'] not in Goat.REDIS_METHODS:
+                raise ValueError("invalid method")
+            return RedisStorage(connect=lambda: self._connect(params))
+        elif params['backend'] == 'memory':
+            return MemoryStorage(**options)
+        elif params['backend'] == 'sqlite':
+            return SQLiteStorage(**options)
+        raise ValueError("invalid backend")
+
+    REDIS_METHODS = ('tcp', 'sock', 'sentinel', 'cluster')
+
+    REDIS_OPTIONS = (
+        'password',
+        'max_connections',
+        'socket_timeout',
+        'socket_connect_timeout',
+        'health_check_interval',
+    )
+
+    def _redis_options(self, params):
+        return dict((k, params[k]) for k in Goat.REDIS_OPTIONS if k in params)
+
+    @property
+    def redis_connection(self):
+        """The Redis client of the current process, or None when storage
+        is not on Redis.
+        """
+
+        return getattr(getattr(self, 'storage', None), 'connection', None)
+
+    def _connect(self, params):
+        import redis
+
+        options = self._redis_options(params)
         if params['method'] == 'tcp':
             return redis.Redis(
                 host=params['host'],
                 port=params['port'],
-                db=params['db'])
+                db=params['db'],
+                **options)
         elif params['method'] == 'sock':
-            return redis.Redis(unix_socket_path=params['sock'])
+            return redis.Redis(unix_socket_path=params['sock'], **options)
+        elif params['method'] == 'sentinel':
+            from redis.sentinel import Sentinel
+            sentinel = Sentinel(params['sentinels'], **options)
+            return sentinel.master_for(
+                params['service'], db=params.get('db', 0))
+        elif params['method'] == 'cluster':
+            from redis.cluster import RedisCluster
+            return RedisCluster(
+                host=params['host'],
+                port=params['port'],
+                **options)
         raise ValueError("invalid method")
 
-    def _auth_url(self):
-        params = {
+    def _http_params(self, app):
+        params = dict(Goat.DEFAULTS['GOAT_HTTP'])
+        params.update(app.config.get('GOAT_HTTP'))
+        return params
+
+    def _subscribe_invalidations(self):
+        """Evicts local cache entries written or deleted by other workers.
+        """
+
+        def listen():
+            while True:
+                try:
+                    for key in self.storage.listen(Goat.INVALIDATE_CHANNEL):
+                        self.local_cache.delete(key)
+                except Exception:
+                    # anything may have changed while we were disconnected
+                    self.local_cache.clear()
+                    time.sleep(1)
+
+        thread = threading.Thread(target=listen, name='goat-invalidations')
+        thread.daemon = True
+        thread.start()
+
+    def _ensure_process(self):
+        """Sets up per-process state when the first request arrives in
+        each process.
+
+        A forked worker drops the calls it inherited in flight and its
+        parent's local cache entries, which may have missed invalidations,
+        and subscribes to invalidations itself.
+        """
+
+        if self._pid == os.getpid():
+            return
+        with self._executor_lock:
+            if self._pid == os.getpid():
+                return
+            if self._pid is not None:
+                self._flights = SingleFlight()
+                if self.local_cache is not None:
+                    self.local_cache.clear()
+            self._pid = os.getpid()
+        if self.local_cache is not None and self.storage.broadcasts:
+            self._subscribe_invalidations()
+
+    def _ensure_refresher(self):
+        """Starts the refresh-ahead thread once in every process.
+        """
+
+        if self._refresher_pid == os.getpid():
+            return
+        with self._executor_lock:
+            if self._refresher_pid == os.getpid():
+                return
+            self._refresher_pid = os.getpid()
+        app = current_app._get_current_object()
+
+        def run():
+            while True:
+                try:
+                    with app.app_context():
+                        if self._lead():
+                            self.refresh()
+                except Exception:
+                    app.logger.exception('goat refresh-ahead failed')
+                time.sleep(self.refresh_ahead['interval'])
+
+        thread = threading.Thread(target=run, name='goat-refresh-ahead')
+        thread.daemon = True
+        thread.start()
+
+    def _lead(self):
+        """Takes or renews the fleet-wide refresh lock.
+        """
+
+        ttl = self.refresh_ahead['interval'] * 2
+        node = self._node.encode('utf-8')
+        if self.storage.add('GOAT_REFRESH_LEADER', node, ttl):
+            return True
+        if self.storage.get('GOAT_REFRESH_LEADER') == node:
+            self.storage.expire('GOAT_REFRESH_LEADER', ttl)
+            return True
+        return False
+
+    def refresh(self):
+        """Renews the team map, and the hot cached memberships and
+        prefetched team sets, that expire within the configured margin.
+
+        Run periodically by the leading worker when GOAT_REFRESH_AHEAD is
+        set; it may also be called directly, e.g. from a scheduled job.
+        """
+
+        margin = (self.refresh_ahead or Goat.REFRESH_AHEAD)['margin']
+        deadline = time.time() + margin
+        refresh_user = self._read('GOAT_REFRESH_USER')
+        if refresh_user is not None:
+            token = self._user_token(refresh_user.decode('utf-8'))
+            marker = self.storage.get('GOAT_TEAMS_REFRESH')
+            if (token and not self._teams_fresh(marker, -margin) and
+                    not self._conserving(token)):
+                self._refresh_org_teams(token)
+
+        hot = [self._hot_entry(key) for key in self.storage.scan(
+            Goat.HOT_PREFIX + '*')]
+        for key in (k for k in hot if k.startswith('GOAT_MEMBERSHIP:')):
+            username = self._key_user(key)
+            entries = self._read(self._membership_key(username), json.loads)
+            token = self._user_token(username)
+            if not entries or not token or self._conserving(token):
+                continue
+            for tid, entry in entries.items():
+                if entry[1] < deadline:
+                    member = self._fetch_membership(token, username, tid)
+                    self._cache_membership(username, tid, member)
+
+        for key in (k for k in hot if k.startswith('GOAT_USER:')):
+            username = self._key_user(key)
+            record = self._user_record(username)
+            entry = record.get('teams') if record else None
+            if (entry and entry['expires'] < deadline and
+                    not self._conserving(record['token'])):
+                self._store_user_teams(
+                    username, self.get_user_teams(record['token']))
+
+    def _mark_hot(self, key, expires):
+        write = self._hot_write(key, expires)
+        if write is not None:
+            self.storage.set(*write)
+
+    def _hot_write(self, key, expires):
+        """Returns the write that flags the cached entries under `key` for
+        :func:`refresh` when one is read within the margin before it
+        expires, or after. Each worker flags a key at most once per margin.
+        """
+
+        if self._hot is None or \
+                expires - time.time() >= self.refresh_ahead['margin']:
+            return None
+        if self._hot.get(key) is not None:
+            return None
+        self._hot.set(key, True)
+        return (Goat.HOT_PREFIX + key, '1',
+                self.refresh_ahead['margin'] + self.refresh_ahead['stale'])
+
+    def _hot_entry(self, key):
+        if isinstance(key, bytes):
+            key = key.decode('utf-8')
+        return key[len(Goat.HOT_PREFIX):]
+
+    def _stale_window(self):
+        """Seconds past expiry a cached value may still be served while
+        the refresher catches up.
+        """
+
+        return self.refresh_ahead['stale'] if self.refresh_ahead else 0
+
+    def _grace(self):
+        """Seconds past expiry a cached value is kept as last-known-good,
+        to be served when GitHub should not or cannot be asked.
+        """
+
+        return max(current_app.config.get('GOAT_GRACE'), self._stale_window())
+
+    def _github(self, method, url, token=None, **kwargs):
+        """Calls the GitHub API and records the token's rate limit.
+        """
+
+        path = self._allow_github(url)
+        status = 'error'
+        try:
+            with self.metrics.timer('goat_github_request_seconds',
+                                    endpoint=path):
+                resp = self.http.request(method, url, **kwargs)
+            status = resp.status_code
+        except self.http.errors as e:
+            self._github_failed(e)
+        finally:
+            self.metrics.inc('goat_github_requests_total',
+                             endpoint=path, status=status)
+        self._github_answered(resp)
+        budget = self._parse_rate_limit(resp)
+        if budget is not None:
+            self._record_rate_limit(token, budget)
+        return resp
+
+    def _allow_github(self, url):
+        """Returns the endpoint of a GitHub call, or raises
+        :class:`CircuitOpen` to fail it fast while the breaker is open.
+        """
+
+        path = endpoint(url)
+        if self.breaker is not None and not self.breaker.allow():
+            self.metrics.inc('goat_github_rejected_total', endpoint=path)
+            raise CircuitOpen(path)
+        return path
+
+    def _github_failed(self, error):
+        if self.breaker is not None:
+            self.breaker.failure()
+        raise GitHubUnavailable(str(error))
+
+    def _github_answered(self, resp):
+        """Counts a server error, which survived the client's retries,
+        as a failure and raises it; any other answer is a success.
+        """
+
+        if resp.status_code >= 500:
+            self._github_failed('GitHub answered {}'.format(resp.status_code))
+        if self.breaker is not None:
+            self.breaker.success()
+
+    def _breaker_changed(self, state):
+        self.metrics.set('goat_breaker_state', {
+            CircuitBreaker.CLOSED: 0,
+            CircuitBreaker.HALF_OPEN: 1,
+            CircuitBreaker.OPEN: 2,
+        }[state])
+        self.metrics.inc('goat_breaker_transitions_total', state=state)
+
+    def _metrics_view(self):
+        return current_app.response_class(
+            self.metrics.render(), mimetype='text/plain; version=0.0.4')
+
+    def _start_trace(self):
+        g.goat_trace = Trace()
+
+    def _finish_trace(self, response):
+        """Adds the request's trace to the response as `Server-Timing`
+        and sends :data:`request_traced`.
+        """
+
+        trace = current_trace()
+        if trace is not None and trace.events:
+            response.headers.add('Server-Timing', trace.server_timing())
+            request_traced.send(current_app._get_current_object(),
+                                trace=trace, response=response)
+        return response
+
+    def _count_cache(self, cache, hit):
+        self.metrics.inc('goat_cache_total', cache=cache,
+                         result='hit' if hit else 'miss')
+
+    def _parse_rate_limit(self, resp):
+        remaining = resp.headers.get('X-RateLimit-Remaining')
+        if remaining is None:
+            return None
+        return {
+            'remaining': int(remaining),
+            'limit': int(resp.headers.get('X-RateLimit-Limit', 0)),
+            'reset': int(resp.headers.get('X-RateLimit-Reset', 0)),
+        }
+
+    def _rate_limit_key(self, token):
+        if not token:
+            return 'GOAT_RATELIMIT:anonymous'
+        if not isinstance(token, bytes):
+            token = token.encode('utf-8')
+        return 'GOAT_RATELIMIT:' + hashlib.sha256(token).hexdigest()[:16]
+
+    def _record_rate_limit(self, token, budget):
+        write = self._rate_limit_write(token, budget)
+        if write is not None:
+            self.storage.set(*write)
+
+    def _rate_limit_write(self, token, budget):
+        """Keeps the token's budget for this process and returns the
+        `(key, value, ttl)` that shares it through storage, or None when
+        this process wrote it within `RATE_LIMIT_SYNC` seconds and it has
+        not crossed the reserve since.
+        """
+
+        key = self._rate_limit_key(token)
+        self._rate_limits.set(key, budget)
+        reserve = current_app.config.get('GOAT_RATELIMIT_RESERVE') or 0
+        low = budget['remaining'] < reserve
+        if self._rate_limits_written.get(key) == low:
+            return None
+        self._rate_limits_written.set(key, low)
+        ttl = max(budget['reset'] - int(time.time()), 1)
+        return key, json.dumps(budget), ttl
+
+    def _budget(self, token):
+        """The token's last known rate limit, shared through storage and
+        re-read at most every `RATE_LIMIT_SYNC` seconds.
+        """
+
+        key = self._rate_limit_key(token)
+        budget = self._rate_limits.get(key, self)
+        if budget is self:
+            raw = self.storage.get(key)
+            budget = json.loads(raw) if raw else None
+            self._rate_limits.set(key, budget)
+        if budget is None or budget['reset'] < time.time():
+            return None
+        return budget
+
+    def _conserving(self, token):
+        """True when the token's remaining budget is below the reserve
+        and cached decisions should be preferred over GitHub calls.
+        """
+
+        reserve = current_app.config.get('GOAT_RATELIMIT_RESERVE')
+        if not reserve:
+            return False
+        budget = self._budget(token)
+        return budget is not None and budget['remaining'] < reserve
+
+    def rate_limits(self):
+        """Returns the last known GitHub rate limit of every token seen,
+        keyed by a digest of the token.
+        """
+
+        limits = {}
+        for key in self.storage.scan('GOAT_RATELIMIT:*'):
+            if isinstance(key, bytes):
+                key = key.decode('utf-8')
+            raw = self.storage.get(key)
+            if raw:
+                limits[key.split(':', 1)[1]] = json.loads(raw)
+        return limits
+
+    def _read(self, key, loads=None):
+        """Reads a key through the local cache, decoding it with `loads`.
+        """
+
+        value = self._local_get(key)
+        if value is not None:
+            return value
+        reads = self._snapshot()
+        if reads is not None and key in reads:
+            value = reads[key]
+        else:
+            value = self.storage.get(key)
+        if value is not None and loads is not None:
+            value = loads(value)
+        if value is not None and self.local_cache is not None:
+            self.local_cache.set(key, value)
+        return value
+
+    def _local_get(self, key):
+        if self.local_cache is None:
+            return None
+        value = self.local_cache.get(key)
+        self._count_cache('local', value is not None)
+        return value
+
+    def _snapshot(self):
+        """Values prefetched for the current request, if any.
+        """
+
+        return g.get('goat_reads') if has_app_context() else None
+
+    def _prefetch(self, keys):
+        """Loads every key a check will read with a single MGET.
+
+        Keys already held by the local cache are skipped; later reads in
+        the same request are served from the snapshot.
+        """
+
+        reads = g.setdefault('goat_reads', {})
+        missing = [k for k in keys if k not in reads and
+                   (self.local_cache is None or k not in self.local_cache)]
+        if missing:
+            reads.update(zip(missing, self.storage.get_many(missing)))
+
+    def _write(self, key, value, ttl=None):
+        """Writes a key and invalidates cached copies in every worker.
+        """
+
+        self._write_many([(key, value, ttl)])
+
+    def _write_many(self, items):
+        """Writes `(key, value, ttl)` triples in a single round-trip.
+        """
+
+        self.storage.set_many(items, self._invalidate(
+            [key for key, _, _ in items]))
+
+    def _delete(self, key):
+        self.storage.delete([key], self._invalidate([key]))
+
+    def _invalidate(self, keys):
+        """Evicts keys from this worker's caches and returns the channel
+        on which other workers should hear about them, if any.
+        """
+
+        reads = self._snapshot()
+        for key in keys:
+            if reads is not None:
+                reads.pop(key, None)
+            if self.local_cache is not None:
+                self.local_cache.delete(key)
+        if self.local_cache is not None:
+            return Goat.INVALIDATE_CHANNEL
+        return None
+
+    def _auth_params(self):
+        return {
             'client_id': current_app.config.get('GOAT_CLIENT_ID'),
-            'state': str(uuid4()),
+            'state': self._new_state(),
             'redirect_uri': current_app.config.get('GOAT_CALLBACK'),
             'scope': current_app.config.get('GOAT_SCOPE'),
         }
-        self.redis_connection.setex(params['state'], '1', 1000)
+
+    def _auth_url(self):
+        params = self._auth_params()
+        if not self._signed_state():
+            self.storage.set(params['state'], '1', 1000)
         return Goat.OAUTH + '/authorize?' + urlencode(params)
 
+    def _signed_state(self):
+        params = current_app.config.get('GOAT_SIGNED_STATE')
+        return dict(Goat.SIGNED_STATE, **params) if params else None
+
+    def _state_serializer(self):
+        return URLSafeTimedSerializer(current_app.secret_key,
+                                      salt='flask-goat-state')
+
+    def _new_state(self):
+        """A random state, signed and timestamped when GOAT_SIGNED_STATE
+        is set so that the callback can verify it without storage.
+        """
+
+        if self._signed_state():
+            return self._state_serializer().dumps(uuid4().hex)
+        return str(uuid4())
+
+    def _state_nonce(self, state, params):
+        """The nonce of a signed state, or None if it is forged or older
+        than `max_age`.
+        """
+
+        try:
+            return self._state_serializer().loads(
+                state, max_age=params['max_age'])
+        except BadSignature:
+            return None
+
+    def _verify_state(self, state):
+        """Checks the callback's state. With `replay` set, a signed state
+        is accepted once: its nonce is remembered for `max_age` seconds,
+        the window in which it could be presented again.
+        """
+
+        params = self._signed_state()
+        if not params:
+            return bool(state) and bool(self.storage.get(state))
+        nonce = self._state_nonce(state, params)
+        if nonce is None:
+            return False
+        if params['replay']:
+            return self.storage.add(
+                'GOAT_STATE:' + nonce, '1', params['max_age'])
+        return True
+
     def _login(self):
         if 'user' in session:
             return redirect(url_for('index'))
@@ -107,6 +744,9 @@ class Goat(object):
             url=url)
 
     def _logout(self):
+        user = session.get('user')
+        if user is not None:
+            self.invalidate_membership(user)
         session.clear()
         return redirect(url_for('login'))
 
@@ -114,28 +754,375 @@ class Goat(object):
         error = request.args.get('error', '')
         if error:
             abort(403)
-        state = request.args.get('state', '')
-        if not self.redis_connection.get(state):
+        if not self._verify_state(request.args.get('state', '')):
             abort(403)
         code = request.args.get('code')
-        token = self.get_token(code)
-        user = self.get_username(token)
-        if self.is_org_member(token, user):
-            session['user'] = user
-            self.redis_connection.set(user, token)
+        try:
+            token = self.get_token(code)
+            user, member = self._resolve_login(token)
+            if member:
+                self._log_in(token, user)
+        except GitHubUnavailable:
+            abort(503)
         return redirect(url_for('index'))
 
-    def get_token(self, code):
-        """Gets a user token for the GitHub API.
+    def _log_in(self, token, user):
+        """Stores the user's record and starts their session. Everything
+        GitHub is asked for comes first, so an outage leaves no session.
         """
 
+        record = self._new_user_record(token)
+        teams = org_teams = None
+        if self._claims_enabled() or \
+                current_app.config.get('GOAT_USER_TEAMS_TTL'):
+            teams = self._login_teams(token, user)
+        if self._claims_enabled():
+            org_teams = self._get_org_teams(token)
+        if current_app.config.get('GOAT_USER_TEAMS_TTL'):
+            record['teams'] = self._user_teams_entry(teams)
+        writes = [self._user_write(user, record)]
+        if self.refresh_ahead:
+            writes.append(('GOAT_REFRESH_USER', user, None))
+        self._write_many(writes)
+        session['user'] = user
+        if self._claims_enabled():
+            self._sign_claim(user, org_teams, teams)
+
+    def _resolve_login(self, token):
+        """Returns the user's login and whether they belong to the
+        organization: in one GraphQL query when GOAT_GRAPHQL is set,
+        otherwise, or if the query fails, in two REST calls.
+        """
+
+        if current_app.config.get('GOAT_GRAPHQL'):
+            viewer = self._graphql_viewer(
+                self._graphql(token, Goat.GRAPHQL_LOGIN))
+            if viewer is not None:
+                return viewer
+        user = self.get_username(token)
+        return user, self.is_org_member(token, user)
+
+    def _login_teams(self, token, username):
+        """Returns the user's organization team ids, through GraphQL when
+        GOAT_GRAPHQL is set and it answers.
+        """
+
+        if current_app.config.get('GOAT_GRAPHQL'):
+            teams, after = set(), None
+            while True:
+                page = self._graphql_teams(self._graphql(
+                    token, Goat.GRAPHQL_TEAMS, login=username, after=after))
+                if page is None:
+                    break
+                teams.update(page[0])
+                after = page[1]
+                if after is None:
+                    return teams
+        return self.get_user_teams(token)
+
+    def _graphql(self, token, query, **variables):
+        variables['org'] = current_app.config.get('GOAT_ORGANIZATION')
+        resp = self._github(
+            'POST', Goat.API + '/graphql', token,
+            headers={'Authorization': 'bearer {}'.format(token),
+                     'Accept': 'application/json'},
+            data=json.dumps({'query': query, 'variables': variables}))
+        return self._graphql_data(resp)
+
+    def _graphql_data(self, resp):
+        """The data of a GraphQL response, or None if it failed in part
+        or in whole.
+        """
+
+        if resp.status_code != 200:
+            return None
+        try:
+            body = json.loads(resp.text)
+        except ValueError:
+            return None
+        if body.get('errors') or not body.get('data'):
+            return None
+        return body['data']
+
+    def _graphql_viewer(self, data):
+        viewer = data.get('viewer') if data else None
+        if not viewer or not viewer.get('organization'):
+            return None
+        return viewer['login'], viewer['organization']['viewerIsAMember']
+
+    def _graphql_teams(self, data):
+        """A page of team ids and the cursor of the next page, if any.
+        """
+
+        org = data.get('organization') if data else None
+        if not org:
+            return None
+        teams = org['teams']
+        info = teams['pageInfo']
+        return ([n['databaseId'] for n in teams['nodes']],
+                info['endCursor'] if info['hasNextPage'] else None)
+
+    def _token_url(self, code):
         params = {
             'client_id': current_app.config.get('GOAT_CLIENT_ID'),
             'client_secret': current_app.config.get('GOAT_CLIENT_SECRET'),
             'code': code
         }
-        resp = requests.post(
-            Goat.OAUTH + '/access_token?' + urlencode(params),
+        return Goat.OAUTH + '/access_token?' + urlencode(params)
+
+    def _verify_signature(self, body):
+        secret = current_app.config.get('GOAT_WEBHOOK_SECRET')
+        if not isinstance(secret, bytes):
+            secret = secret.encode('utf-8')
+        signature = request.headers.get('X-Hub-Signature-256', '')
+        digest = hmac.new(secret, body, hashlib.sha256).hexdigest()
+        return hmac.compare_digest(signature, 'sha256=' + digest)
+
+    def _webhook_event(self):
+        body = request.get_data()
+        if not self._verify_signature(body):
+            abort(403)
+        payload = json.loads(body) if body else {}
+        return request.headers.get('X-GitHub-Event', ''), payload
+
+    def _webhook(self):
+        """Applies GitHub organization webhooks to the cached team map and
+        membership data so revocations take effect without waiting for a TTL.
+        """
+
+        event, payload = self._webhook_event()
+        if event == 'membership' and payload.get('scope') == 'team':
+            self.apply_membership(
+                payload['member']['login'],
+                payload['team'],
+                payload.get('action') == 'added')
+        elif event == 'team':
+            self.apply_team(payload.get('action'), payload['team'],
+                            payload.get('changes', {}))
+        elif (event == 'organization' and
+                payload.get('action') == 'member_removed'):
+            self.revoke(payload['membership']['user']['login'])
+        return '', 204
+
+    def apply_membership(self, username, team, member):
+        """Records that the user joined or left the team.
+        """
+
+        tid = team['id']
+        key = self._membership_key(username)
+        entries = self._read(key, json.loads)
+        ttl = self._membership_ttl(member)
+        if ttl:
+            self._write(key, *self._merge_membership(entries, tid, member, ttl))
+        elif entries and str(tid) in entries:
+            dropped = self._drop_membership(entries, tid)
+            if dropped is None:
+                self._delete(key)
+            else:
+                self._write(key, *dropped)
+
+        record = self._user_record(username)
+        if record and record.get('teams'):
+            record['teams'] = self._updated_user_teams(
+                record['teams'], tid, member)
+            self._write(*self._user_write(username, record))
+
+        if member and 'name' in team:
+            self.apply_team('created', team, {})
+
+    def apply_team(self, action, team, changes):
+        """Updates the cached team map for a created, renamed or deleted
+        team.
+        """
+
+        teams = self._read('GOAT_TEAMS', json.loads)
+        teams = self._updated_team_map(teams, action, team, changes)
+        if teams is not None:
+            self._write('GOAT_TEAMS', json.dumps(teams))
+
+    def _updated_user_teams(self, entry, tid, member):
+        teams = set(entry['teams'])
+        if member:
+            teams.add(tid)
+        else:
+            teams.discard(tid)
+        return dict(entry, teams=sorted(teams))
+
+    def _updated_team_map(self, teams, action, team, changes):
+        """Returns the team map with a webhook's change applied, or None
+        when there is nothing to write.
+        """
+
+        if teams is None:
+            return None
+        updated = dict(teams)
+        if action == 'deleted':
+            updated.pop(team['name'], None)
+        elif action in ('created', 'edited'):
+            old_name = changes.get('name', {}).get('from')
+            if old_name is not None:
+                updated.pop(old_name, None)
+            updated[team['name']] = team['id']
+        return updated if updated != teams else None
+
+    def revoke(self, username):
+        """Forgets the user's token and cached memberships, e.g. after they
+        were removed from the organization.
+        """
+
+        self._delete(self._membership_key(username))
+        self._delete(self._user_key(username))
+        self._delete(username)
+
+    def _coalesce(self, key, fetch, ready, stale, shared=True):
+        """Runs `fetch` once per key across the threads and workers that
+        need it at the same time.
+
+        Threads of this process share the leader's result. Workers that
+        lose the GOAT_LOCK race poll `ready` for the result the leader
+        stores; once the wait runs out, or the lock is gone with nothing
+        stored, they take the last-known value from `stale` or fetch it
+        themselves. `stale` also answers while GitHub is unavailable.
+        Pass `shared=False` when the result will not be stored; only the
+        threads of this process are coalesced then.
+        """
+
+        try:
+            return self._flights.do(key, lambda: self._coalesce_workers(
+                key, fetch, ready, stale, shared))
+        except GitHubUnavailable:
+            result = stale()
+            if result is None:
+                raise
+            return result
+
+    def _coalesce_workers(self, key, fetch, ready, stale, shared=True):
+        params = current_app.config.get('GOAT_COALESCE')
+        if not params or not shared:
+            return fetch()
+        lock = 'GOAT_LOCK:' + key
+        node = self._node.encode('utf-8')
+        if self.storage.add(lock, node, params['lock']):
+            try:
+                return fetch()
+            finally:
+                if self.storage.get(lock) == node:
+                    self.storage.delete([lock])
+        deadline = time.time() + params['wait']
+        while time.time() < deadline:
+            time.sleep(Goat.COALESCE_POLL)
+            result = ready()
+            if result is not None:
+                return result
+            if self.storage.get(lock) is None:
+                break
+        result = stale()
+        return result if result is not None else fetch()
+
+    def _stored(self, key):
+        """Reads and decodes a key straight from storage, bypassing the
+        request snapshot and the local cache.
+        """
+
+        raw = self.storage.get(key)
+        return json.loads(raw) if raw is not None else None
+
+    def _user_key(self, username):
+        # shares the hash tag of the user's other keys
+        return 'GOAT_USER:{{{}}}'.format(username)
+
+    def _new_user_record(self, token):
+        return {'token': token, 'seen': time.time(), 'teams': None}
+
+    def _user_write(self, username, record):
+        """The write of a user record, which expires GOAT_USER_TTL seconds
+        after it was last seen.
+        """
+
+        ttl = current_app.config.get('GOAT_USER_TTL') or None
+        return self._user_key(username), json.dumps(record), ttl
+
+    def _user_record(self, username):
+        """Returns the user's record: their token, when they were last
+        seen and their prefetched team set.
+
+        A token stored under the bare user name by an older release is
+        moved into a record the first time it is read.
+        """
+
+        record = self._read(self._user_key(username), json.loads)
+        if record is not None:
+            return record
+        token = self._read(username)
+        if token is None:
+            return None
+        record = self._new_user_record(token.decode('utf-8'))
+        self._write(*self._user_write(username, record))
+        self._delete(username)
+        return record
+
+    def _user_token(self, username):
+        record = self._user_record(username)
+        return record['token'] if record else None
+
+    def _active_token(self, username):
+        """Returns the token of a user making a request, sliding their
+        record's expiry forward once a tenth of GOAT_USER_TTL has passed
+        since they were last seen.
+        """
+
+        record = self._user_record(username)
+        if record is None:
+            return None
+        if self._stale_record(record):
+            record['seen'] = time.time()
+            self._write(*self._user_write(username, record))
+        return record['token']
+
+    def _stale_record(self, record):
+        ttl = current_app.config.get('GOAT_USER_TTL')
+        return bool(ttl) and \
+            record['seen'] + ttl * Goat.USER_TOUCH < time.time()
+
+    def sweep(self, idle=None):
+        """Deletes the records of users not seen for `idle` seconds
+        (GOAT_USER_TTL by default) with their cached memberships, and
+        cached memberships left without a record. Returns the number of
+        users removed.
+        """
+
+        idle = idle or current_app.config.get('GOAT_USER_TTL')
+        swept = set()
+        if idle:
+            cutoff = time.time() - idle
+            for key in self.storage.scan(self._user_key('*')):
+                raw = self.storage.get(key)
+                if raw is not None and json.loads(raw)['seen'] < cutoff:
+                    swept.add(self._key_user(key))
+        for key in self.storage.scan(self._membership_key('*')):
+            username = self._key_user(key)
+            if self.storage.get(self._user_key(username)) is None:
+                swept.add(username)
+        # straight to storage, which AsyncGoat shares with Goat
+        keys = [k for username in swept
+                for k in (self._membership_key(username),
+                          self._user_key(username))]
+        if keys:
+            self.storage.delete(keys, self._invalidate(keys))
+        return len(swept)
+
+    def _sweep_command(self):
+        """Deletes the auth records of inactive users."""
+
+        print('{} users swept'.format(self.sweep()))
+
+    def get_token(self, code):
+        """Gets a user token for the GitHub API.
+        """
+
+        resp = self._github(
+            'POST',
+            self._token_url(code),
             headers={'Accept': 'application/json'}
         )
         data = json.loads(resp.text)
@@ -146,42 +1133,191 @@ class Goat(object):
         """
 
         url = Goat.API + '/user?access_token={}'.format(token)
-        resp = requests.get(url, headers={'Accept': 'application/json'})
+        resp = self._github(
+            'GET', url, token, headers={'Accept': 'application/json'})
         data = json.loads(resp.text)
         return data.get('login', None)
 
+    def get_user_teams(self, token):
+        """Gets the ids of every organization team the user belongs to.
+        """
+
+        url = Goat.API + '/user/teams?per_page=100&access_token={}'.format(
+            token)
+        teams = set()
+        while url:
+            resp = self._github(
+                'GET', url, token, headers={'Accept': 'application/json'})
+            teams.update(self._org_team_ids(json.loads(resp.text)))
+            url = resp.links.get('next', {}).get('url')
+        return teams
+
+    def _org_team_ids(self, data):
+        org = current_app.config.get('GOAT_ORGANIZATION').lower()
+        return set(t['id'] for t in data
+                   if t.get('organization', {}).get('login', '').lower() == org)
+
+    def _user_teams_entry(self, teams):
+        ttl = current_app.config.get('GOAT_USER_TEAMS_TTL')
+        return {'teams': sorted(teams), 'expires': time.time() + ttl}
+
+    def _fresh_user_teams(self, entry, fallback=False):
+        limit = self._grace() if fallback else self._stale_window()
+        if entry and entry['expires'] + limit >= time.time():
+            return set(entry['teams'])
+        return None
+
+    def _store_user_teams(self, username, teams):
+        record = self._user_record(username)
+        if record is not None:
+            record['teams'] = self._user_teams_entry(teams)
+            self._write(*self._user_write(username, record))
+
+    def _user_teams(self, token, username):
+        """Returns the user's prefetched team ids, refreshing them once
+        they expire, or None when prefetching is disabled.
+        """
+
+        if not current_app.config.get('GOAT_USER_TEAMS_TTL') or not token:
+            return None
+        record = self._user_record(username)
+        entry = record.get('teams') if record else None
+        teams = self._fresh_user_teams(entry)
+        self._count_cache('user_teams', teams is not None)
+        if teams is not None:
+            self._mark_hot(self._user_key(username), entry['expires'])
+        if teams is None and entry and self._conserving(token):
+            teams = self._fresh_user_teams(entry, fallback=True)
+        if teams is not None:
+            return teams
+
+        key = self._user_key(username)
+
+        def fetch():
+            teams = self.get_user_teams(token)
+            self._store_user_teams(username, teams)
+            return teams
+
+        return self._coalesce(
+            key + ':teams', fetch,
+            lambda: self._fresh_user_teams(
+                (self._stored(key) or {}).get('teams')),
+            lambda: self._fresh_user_teams(entry, fallback=True))
+
     def _get_org_teams(self, token):
         """Gets a list of all teams within the organization.
         """
 
-        teams = self.redis_connection.get('GOAT_TEAMS')
-        if teams:
-            return json.loads(teams)
+        teams = self._read('GOAT_TEAMS', json.loads)
+        marker = self._read('GOAT_TEAMS_REFRESH')
+        if teams is not None and (
+                self._teams_fresh(marker, self._stale_window()) or
+                self._conserving(token)):
+            return teams
+
+        def ready():
+            if self._teams_fresh(self.storage.get('GOAT_TEAMS_REFRESH')):
+                return self._stored('GOAT_TEAMS')
+
+        return self._coalesce(
+            'GOAT_TEAMS', lambda: self._refresh_org_teams(token),
+            ready, lambda: teams)
+
+    def _refresh_org_teams(self, token):
+        """Revalidates the team map page by page with `If-None-Match`.
+
+        Unchanged pages come back as 304 responses, which GitHub does not
+        count against the rate limit. The map is only rewritten when a
+        page changed; otherwise just its refresh deadline is extended.
+        """
+
+        pages = self._read('GOAT_TEAMS_PAGES', json.loads) or []
+        fetched = []
+        changed = False
+        while True:
+            old = pages[len(fetched)] if len(fetched) < len(pages) else None
+            resp = self._github(
+                'GET',
+                self._org_teams_url(token, len(fetched) + 1),
+                token,
+                headers=self._team_page_headers(old))
+            page = self._team_page(resp, old)
+            changed = changed or page is not old
+            fetched.append(page)
+            if not page['next']:
+                break
+        changed = changed or len(fetched) != len(pages)
+
+        teams = self._merge_team_pages(fetched)
+        if changed:
+            self._write('GOAT_TEAMS', json.dumps(teams))
+            self._write('GOAT_TEAMS_PAGES', json.dumps(fetched))
+        self._write(*self._teams_marker())
+        return teams
 
-        url = Goat.API + '/orgs/{}/teams?access_token={}'.format(
+    def _teams_marker(self):
+        """The write that marks the team map fresh until its refresh
+        deadline, kept past it for the stale window.
+        """
+
+        return ('GOAT_TEAMS_REFRESH', repr(time.time() + Goat.REFRESH_TEAMS),
+                Goat.REFRESH_TEAMS + self._stale_window())
+
+    def _teams_fresh(self, marker, window=0):
+        """Whether the team map is at most `window` seconds past the
+        refresh deadline held by its marker.
+        """
+
+        return marker is not None and float(marker) + window >= time.time()
+
+    def _org_teams_url(self, token, page=1):
+        return Goat.API + '/orgs/{}/teams?per_page=100&page={}&access_token={}'.format(
             current_app.config.get('GOAT_ORGANIZATION'),
+            page,
             token
         )
 
-        resp = requests.get(url, headers={'Accept': 'application/json'})
-        data = json.loads(resp.text)
-        teams = dict([(t['name'], t['id']) for t in data if 'name' in t])
+    def _team_page_headers(self, old):
+        headers = {'Accept': 'application/json'}
+        if old and old.get('etag'):
+            headers['If-None-Match'] = old['etag']
+        return headers
 
-        self.redis_connection.setex(
-            'GOAT_TEAMS',
-            json.dumps(teams),
-            Goat.REFRESH_TEAMS
-        )
+    def _team_page(self, resp, old):
+        """Returns the cached page on a 304, or a new page entry on a 200.
+
+        Any other answer, such as a 403 once the rate limit is spent, is
+        an error body rather than a page; it raises so that the stored map
+        and its refresh deadline are left as they are.
+        """
+
+        if resp.status_code == 304 and old is not None:
+            return old
+        if resp.status_code != 200:
+            raise GitHubUnavailable('team map page answered {}'.format(
+                resp.status_code))
+        return {
+            'etag': resp.headers.get('ETag'),
+            'teams': self._org_team_map(json.loads(resp.text)),
+            'next': 'next' in resp.links,
+        }
 
+    def _merge_team_pages(self, pages):
+        teams = {}
+        for page in pages:
+            teams.update(page['teams'])
         return teams
 
+    def _org_team_map(self, data):
+        return dict([(t['name'], t['id']) for t in data if 'name' in t])
+
     def is_org_member(self, token, username):
         """Checks if the user is a member of the organization.
         """
 
         org = current_app.config.get('GOAT_ORGANIZATION')
         url = '/orgs/{}/members/{}'.format(org, username)
-        resp = requests.get(Goat.API + url)
+        resp = self._github('GET', Goat.API + url)
         return resp.status_code == 204
 
     def is_team_member(self, token, username, team):
@@ -193,43 +1329,435 @@ class Goat(object):
         if not tid:
             return False
 
-        url = '/teams/{}/memberships/{}?access_token={}'.format(
-            tid, username, token)
-        resp = requests.get(Goat.API + url)
+        cached = self._cached_membership(
+            username, tid, self._conserving(token))
+        if cached is not None:
+            return cached
+
+        def fetch():
+            member = self._fetch_membership(token, username, tid)
+            self._cache_membership(username, tid, member)
+            return member
+
+        key = self._membership_key(username)
+        return self._coalesce(
+            '{}:{}'.format(key, tid), fetch,
+            lambda: self._membership_hit(self._stored(key), tid),
+            lambda: self._cached_membership(username, tid, fallback=True),
+            self._cache_enabled())
+
+    def _fetch_membership(self, token, username, tid):
+        resp = self._github(
+            'GET', self._team_membership_url(tid, username, token), token)
         return resp.status_code == 200
 
-    def members_only(self, *teams):
-        """Authorization view_func decorator.
-        Permits the intersection of team members to pass.
+    def _team_membership_url(self, tid, username, token):
+        return Goat.API + '/teams/{}/memberships/{}?access_token={}'.format(
+            tid, username, token)
+
+    def _membership_key(self, username):
+        # the hash tag keeps a user's keys on the slot of their token
+        return 'GOAT_MEMBERSHIP:{{{}}}'.format(username)
+
+    def _key_user(self, key):
+        if isinstance(key, bytes):
+            key = key.decode('utf-8')
+        return key.split(':', 1)[1][1:-1]
+
+    def _membership_ttl(self, member):
+        if member:
+            return current_app.config.get('GOAT_MEMBERSHIP_TTL')
+        return current_app.config.get('GOAT_MEMBERSHIP_NEGATIVE_TTL')
+
+    def _cache_enabled(self):
+        return bool(current_app.config.get('GOAT_MEMBERSHIP_TTL') or
+                    current_app.config.get('GOAT_MEMBERSHIP_NEGATIVE_TTL'))
+
+    def _cached_membership(self, username, tid, fallback=False):
+        """Returns a cached membership decision or None on a miss.
+        With `fallback`, last-known-good decisions within the grace
+        window count as hits.
+        """
+
+        if not self._cache_enabled():
+            return None
+        key = self._membership_key(username)
+        entries = self._read(key, json.loads)
+        member = self._membership_hit(entries, tid, fallback)
+        if member is not None:
+            self._mark_hot(key, entries[str(tid)][1])
+        return member
+
+    def _membership_hit(self, entries, tid, fallback=False):
+        entry = entries.get(str(tid)) if entries else None
+        limit = self._grace() if fallback else self._stale_window()
+        if entry is None or entry[1] + limit < time.time():
+            self.cache_stats['misses'] += 1
+            self._count_cache('membership', False)
+            return None
+        self.cache_stats['hits'] += 1
+        self._count_cache('membership', True)
+        return entry[0]
+
+    def _cache_membership(self, username, tid, member):
+        ttl = self._membership_ttl(member)
+        if not ttl:
+            return
+        key = self._membership_key(username)
+        entries = self._read(key, json.loads)
+        self._write(key, *self._merge_membership(entries, tid, member, ttl))
+
+    def _merge_membership(self, entries, tid, member, ttl):
+        """Adds a decision to the user's cached entries, dropping expired
+        ones. Returns the encoded entries and the key's TTL.
+        """
+
+        now = time.time()
+        stale = self._grace()
+        entries = dict((k, v) for k, v in (entries or {}).items()
+                       if v[1] + stale >= now)
+        entries[str(tid)] = [member, now + ttl]
+        expires = max(v[1] for v in entries.values()) + stale
+        return json.dumps(entries), int(expires - now) + 1
+
+    def _drop_membership(self, entries, tid):
+        """Removes a decision from the user's cached entries, dropping
+        expired ones. Returns the encoded entries and the key's TTL, or
+        None when no entry is left.
+        """
+
+        now = time.time()
+        stale = self._grace()
+        entries = dict((k, v) for k, v in entries.items()
+                       if k != str(tid) and v[1] + stale >= now)
+        if not entries:
+            return None
+        expires = max(v[1] for v in entries.values()) + stale
+        return json.dumps(entries), int(expires - now) + 1
+
+    def access_matrix(self, token, users, teams, cache=False):
+        """Returns `{user: {team: bool}}` for every user and team.
+
+        Each team's member list is fetched once, teams in parallel on the
+        worker pool, instead of probing every pair. Teams missing from the
+        organization, or whose members the token may not read, admit
+        nobody. With `cache`, the positive decisions
+        are written to the membership cache read by the decorators; member
+        lists leave out pending members, so a negative is not cached.
+        """
+
+        tids = self._matrix_teams(self._get_org_teams(token), teams)
+        wanted = sorted(set(t for t in tids.values() if t))
+        if self.workers < 2 or len(wanted) < 2:
+            members = [self._team_logins(token, tid) for tid in wanted]
+        else:
+            app = current_app._get_current_object()
+
+            def fetch(tid):
+                with app.app_context():
+                    return self._team_logins(token, tid)
+
+            members = list(self.executor.map(fetch, wanted))
+        members = dict(zip(wanted, members))
+        matrix = self._matrix(users, tids, members)
+        if cache and self._membership_ttl(True):
+            positives = self._matrix_positives(matrix, tids, members)
+            keys = [self._membership_key(login) for login in positives]
+            writes = self._matrix_writes(
+                positives, keys, self.storage.get_many(keys))
+            if writes:
+                self._write_many(writes)
+        return matrix
+
+    def get_team_members(self, token, tid):
+        """Gets the lowercased logins of every active member of a team.
+        """
+
+        return set(self._team_logins(token, tid))
+
+    def _team_logins(self, token, tid):
+        """Maps the lowercased logins of a team's active members to the
+        logins as GitHub spells them, which is how sessions name users.
+        """
+
+        url = self._team_members_url(token, tid)
+        logins = {}
+        while url:
+            resp = self._github(
+                'GET', url, token, headers={'Accept': 'application/json'})
+            logins.update(self._member_logins(resp))
+            url = resp.links.get('next', {}).get('url')
+        return logins
+
+    def _member_logins(self, resp):
+        """Reads a page of a team's member list. A team the token may
+        not read has no members it can see.
+        """
+
+        if resp.status_code in (403, 404):
+            return {}
+        if resp.status_code != 200:
+            raise GitHubUnavailable(
+                'team members answered {}'.format(resp.status_code))
+        return dict((m['login'].lower(), m['login'])
+                    for m in json.loads(resp.text))
+
+    def _team_members_url(self, token, tid):
+        return Goat.API + '/teams/{}/members?per_page=100&access_token={}'.format(
+            tid, token)
+
+    def _matrix_teams(self, org_teams, teams):
+        return dict((team, org_teams.get(team)) for team in teams)
+
+    def _matrix(self, users, tids, members):
+        return dict((user, dict(
+            (team, bool(tid) and user.lower() in members[tid])
+            for team, tid in tids.items())) for user in users)
+
+    def _matrix_positives(self, matrix, tids, members):
+        """Maps the GitHub login of every user found in a team to the ids
+        of the teams they were found in.
+        """
+
+        positives = {}
+        for user, decisions in matrix.items():
+            for team, member in decisions.items():
+                if member:
+                    tid = tids[team]
+                    login = members[tid][user.lower()]
+                    positives.setdefault(login, set()).add(tid)
+        return positives
+
+    def _matrix_writes(self, positives, keys, raws):
+        """Merges the positive decisions into the users' cached
+        membership entries.
+        """
+
+        ttl = self._membership_ttl(True)
+        writes = []
+        for key, raw in zip(keys, raws):
+            entries = json.loads(raw) if raw is not None else None
+            for tid in sorted(positives[self._key_user(key)]):
+                encoded, key_ttl = self._merge_membership(
+                    entries, tid, True, ttl)
+                entries = json.loads(encoded)
+            writes.append((key, encoded, key_ttl))
+        return writes
+
+    def invalidate_membership(self, username):
+        """Drops every cached membership decision and the prefetched
+        team set for the user.
+        """
+
+        self._delete(self._membership_key(username))
+        record = self._user_record(username)
+        if record and record.get('teams'):
+            record['teams'] = None
+            self._write(*self._user_write(username, record))
+
+    @property
+    def executor(self):
+        """Worker pool shared by every decorated view of this instance.
+        """
+
+        if self._executor_pid != os.getpid():
+            with self._executor_lock:
+                if self._executor_pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(self.workers)
+                    self._executor_pid = os.getpid()
+        return self._executor
+
+    def _check_teams(self, token, username, teams, require_all=True):
+        """Checks team memberships concurrently.
+
+        Returns as soon as the outcome is known: on the first failed team
+        when `require_all` is set, on the first passed team otherwise.
+        Checks that have not started yet are cancelled. When the user's
+        team set has been prefetched the check is a local set operation.
+        """
+
+        team_ids = self._user_teams(token, username)
+        if team_ids is not None:
+            return self._match_teams(
+                self._get_org_teams(token), team_ids, teams, require_all)
+
+        if len(teams) < 2 or self.workers < 2:
+            for team in teams:
+                if self.is_team_member(token, username, team) != require_all:
+                    return not require_all
+            return require_all
+
+        # load the team map once rather than once per worker
+        self._get_org_teams(token)
+        app = current_app._get_current_object()
+        reads = self._snapshot()
+        trace = current_trace()
+
+        def check(team):
+            with app.app_context():
+                g.goat_reads = reads
+                g.goat_trace = trace
+                return self.is_team_member(token, username, team)
+
+        futures = [self.executor.submit(check, team) for team in teams]
+        try:
+            for future in as_completed(futures):
+                if future.result() != require_all:
+                    return not require_all
+            return require_all
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def _match_teams(self, org_teams, team_ids, teams, require_all):
+        found = [org_teams.get(team) in team_ids for team in teams]
+        return all(found) if require_all else any(found)
+
+    def _check_policy(self, token, username, policy):
+        """Evaluates a compiled policy against the user's team set, or
+        against one membership check per team when team sets are not
+        prefetched.
+        """
+
+        org_teams = self._get_org_teams(token)
+        team_ids = self._user_teams(token, username)
+        if team_ids is None:
+            team_ids = set(
+                tid for team, tid in zip(policy.teams, policy.ids(org_teams))
+                if tid is not None and
+                self.is_team_member(token, username, team))
+        return policy.allows(policy.mask(org_teams, team_ids))
+
+    def _claims_enabled(self):
+        return bool(current_app.config.get('GOAT_CLAIM_TTL'))
+
+    def _claim_serializer(self):
+        return URLSafeTimedSerializer(current_app.secret_key,
+                                      salt='flask-goat-claim')
+
+    def _claim(self, username):
+        """Teams named in the user's session claim, or None when the claim
+        is missing, forged, expired or issued to someone else.
+        """
+
+        signed = session.get('goat_claim')
+        if not signed:
+            return None
+        try:
+            claim = self._claim_serializer().loads(
+                signed, max_age=current_app.config.get('GOAT_CLAIM_TTL'))
+        except BadSignature:
+            return None
+        if claim.get('user') != username:
+            return None
+        return claim['teams']
+
+    def _sign_claim(self, username, org_teams, team_ids):
+        """Writes a claim of the user's teams, by name and id, into the
+        session; the signature carries its issue time.
+        """
+
+        teams = dict((name, tid) for name, tid in org_teams.items()
+                     if tid in team_ids)
+        session['goat_claim'] = self._claim_serializer().dumps(
+            {'user': username, 'teams': teams})
+        return teams
+
+    def _issue_claim(self, username):
+        """Re-validates an expired claim against the team set and the
+        team map. Returns None when the user no longer has a token.
+        """
+
+        token = self._active_token(username)
+        if not token:
+            session.pop('goat_claim', None)
+            return None
+        team_ids = self._user_teams(token, username)
+        if team_ids is None:
+            team_ids = self.get_user_teams(token)
+        return self._sign_claim(
+            username, self._get_org_teams(token), team_ids)
+
+    def _auth_keys(self, username):
+        """Every key an authorization check for the user may read.
+        """
+
+        return [
+            self._user_key(username),
+            'GOAT_TEAMS',
+            'GOAT_TEAMS_REFRESH',
+            self._membership_key(username),
+            # an older release's token, read when there is no record
+            username,
+        ]
+
+    def _protect(self, check, match):
+        """Wraps a view in an authorization check.
+
+        `check(token, username)` looks the user's teams up; `match(teams,
+        team_ids)` decides from a session claim's name-to-id map instead.
         """
 
         def wrapper(f):
             @wraps(f)
             def wrapped(*args, **kwargs):
                 if 'user' not in session:
+                    self._count_decision('login')
                     return redirect(url_for('login'))
-                token = self.redis_connection.get(session['user'])
-                for team in teams:
-                    if not self.is_team_member(token, session['user'], team):
-                        abort(403)
-                return f(*args, **kwargs)
+                user = session['user']
+                with self.metrics.timer('goat_decision_seconds',
+                                        view=request.endpoint):
+                    try:
+                        if self._claims_enabled():
+                            teams = self._claim(user)
+                            if teams is None:
+                                self._prefetch(self._auth_keys(user))
+                                teams = self._issue_claim(user)
+                            allowed = teams is not None and \
+                                match(teams, set(teams.values()))
+                        else:
+                            self._prefetch(self._auth_keys(user))
+                            allowed = check(self._active_token(user), user)
+                    except GitHubUnavailable:
+                        self._count_decision('unavailable')
+                        abort(503)
+                self._count_decision('allow' if allowed else 'deny')
+                if not allowed:
+                    abort(403)
+                with self.metrics.timer('goat_view_seconds',
+                                        view=request.endpoint):
+                    return f(*args, **kwargs)
             return wrapped
         return wrapper
 
+    def _count_decision(self, outcome):
+        self.metrics.inc('goat_decisions_total',
+                         view=request.endpoint, outcome=outcome)
+
+    def members_only(self, *teams):
+        """Authorization view_func decorator.
+        Permits the intersection of team members to pass.
+        """
+
+        return self._protect(
+            lambda token, user: self._check_teams(token, user, teams, True),
+            lambda org, ids: self._match_teams(org, ids, teams, True))
+
     def members_union(self, *teams):
         """Authorization view_func decorator.
         Permits the union of team members to pass.
         """
 
-        def wrapper(f):
-            @wraps(f)
-            def wrapped(*args, **kwargs):
-                if 'user' not in session:
-                    return redirect(url_for('login'))
-                token = self.redis_connection.get(session['user'])
-                for team in teams:
-                    if self.is_team_member(token, session['user'], team):
-                        return f(*args, **kwargs)
-                abort(403)
-            return wrapped
-        return wrapper
+        return self._protect(
+            lambda token, user: self._check_teams(token, user, teams, False),
+            lambda org, ids: self._match_teams(org, ids, teams, False))
+
+    def members_policy(self, policy):
+        """Authorization view_func decorator.
+        Permits the users a :class:`Policy` of teams allows to pass.
+        """
+
+        policy = CompiledPolicy(policy)
+        return self._protect(
+            lambda token, user: self._check_policy(token, user, policy),
+            lambda org, ids: policy.allows(policy.mask(org, ids)))
@@ -0,0 +1,903 @@
+import time
+import asyncio
+import weakref
+import threading
+import httpx
+import simplejson as json
+from functools import wraps
+from inspect import iscoroutinefunction
+from redis import asyncio as aioredis
+from flask import current_app, request, abort, session,\
+    redirect, url_for, render_template, g
+from . import Goat, urlencode
+from .breaker import GitHubUnavailable
+from .client import HTTPClient
+from .storage import RedisStorage
+from .metrics import MeteredStorage, NullMetrics
+
+
+class _LoopLocal(object):
+
+    """Holds one instance of a loop-bound client per event loop.
+
+    Flask runs each async view on its own event loop, and neither httpx
+    nor redis connections may be shared between loops. Each instance is
+    reused for as long as its loop runs and, given `close`, closed when
+    the loop shuts down: a task parked on the loop awaits `close` once
+    `asyncio.run` cancels it.
+    """
+
+    def __init__(self, factory, close=None):
+        self.factory = factory
+        self.close = close
+        self._values = weakref.WeakKeyDictionary()
+        # the closers hold their loops; keep them only until they run
+        self._closers = set()
+        self._lock = threading.Lock()
+
+    def get(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            value = self._values.get(loop)
+            if value is None:
+                value = self._values[loop] = self.factory()
+                if self.close is not None:
+                    self._closers.add(loop.create_task(
+                        self._close_with_loop(loop, value)))
+        return value
+
+    async def _close_with_loop(self, loop, value):
+        try:
+            await loop.create_future()
+        finally:
+            with self._lock:
+                self._values.pop(loop, None)
+                self._closers.discard(asyncio.current_task())
+            await self.close(value)
+
+
+class AsyncHTTPClient(object):
+
+    """Asyncio counterpart of :class:`HTTPClient` built on httpx.
+
+    Connection errors are retried by the transport; 5xx responses to GET
+    requests are retried here with exponential backoff.
+    """
+
+    RETRY_STATUSES = HTTPClient.RETRY_STATUSES
+
+    def __init__(self, pool_size=10, connect_timeout=3.05, read_timeout=10,
+                 retries=3, backoff=0.3, transport=None):
+        self.pool_size = pool_size
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.transport = transport
+        self._client = _LoopLocal(self._create_client,
+                                  lambda client: client.aclose())
+
+    @property
+    def client(self):
+        return self._client.get()
+
+    def _create_client(self):
+        limits = httpx.Limits(
+            max_connections=self.pool_size,
+            max_keepalive_connections=self.pool_size,
+        )
+        transport = self.transport or httpx.AsyncHTTPTransport(
+            retries=self.retries, limits=limits)
+        return httpx.AsyncClient(transport=transport, timeout=self.timeout)
+
+    async def request(self, method, url, **kwargs):
+        attempt = 0
+        while True:
+            resp = await self.client.request(method, url, **kwargs)
+            if (method != 'GET' or attempt >= self.retries or
+                    resp.status_code not in self.RETRY_STATUSES):
+                return resp
+            await asyncio.sleep(self.backoff * (2 ** attempt))
+            attempt += 1
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+
+class AsyncRedisStorage(object):
+
+    """Coroutine counterpart of :class:`RedisStorage` on `redis.asyncio`.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    async def get(self, key):
+        return await self.connection.get(key)
+
+    async def get_many(self, keys):
+        mget = getattr(self.connection, 'mget_nonatomic',
+                       self.connection.mget)
+        return await mget(keys)
+
+    async def set(self, key, value, ttl=None):
+        await self.set_many([(key, value, ttl)])
+
+    @property
+    def _cluster(self):
+        return hasattr(self.connection, 'get_default_node')
+
+    async def set_many(self, items, channel=None):
+        cluster = self._cluster
+        pipe = self.connection.pipeline(transaction=False)
+        for key, value, ttl in items:
+            pipe.set(key, value, ex=ttl)
+            if channel is not None and not cluster:
+                pipe.publish(channel, key)
+        await pipe.execute()
+        if channel is not None and cluster:
+            await self._publish(channel, [key for key, _, _ in items])
+
+    async def delete(self, keys, channel=None):
+        cluster = self._cluster
+        pipe = self.connection.pipeline(transaction=False)
+        if cluster:
+            for key in keys:
+                pipe.delete(key)
+        else:
+            pipe.delete(*keys)
+            if channel is not None:
+                for key in keys:
+                    pipe.publish(channel, key)
+        await pipe.execute()
+        if channel is not None and cluster:
+            await self._publish(channel, keys)
+
+    async def _publish(self, channel, keys):
+        # cluster pipelines refuse PUBLISH; send the messages side by side
+        await asyncio.gather(
+            *[self.connection.publish(channel, key) for key in keys])
+
+    async def add(self, key, value, ttl):
+        return bool(await self.connection.set(key, value, nx=True, ex=ttl))
+
+    async def ttl(self, key):
+        ttl = await self.connection.ttl(key)
+        if ttl == -1:
+            return None
+        return max(ttl, 0)
+
+    async def scan(self, pattern):
+        return [key async for key in self.connection.scan_iter(pattern)]
+
+    async def close(self):
+        close = getattr(self.connection, 'aclose', None) or \
+            self.connection.close
+        await close()
+
+
+class _LocalStorage(object):
+
+    """Exposes an in-process or SQLite backend through coroutines; their
+    calls never wait on the network.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def __getattr__(self, name):
+        method = getattr(self.storage, name)
+
+        async def call(*args, **kwargs):
+            return method(*args, **kwargs)
+        return call
+
+
+class _MeteredAsyncStorage(object):
+
+    """Times the coroutines of another async backend.
+    """
+
+    def __init__(self, storage, metrics):
+        self.storage = storage
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        method = getattr(self.storage, name)
+
+        async def call(*args, **kwargs):
+            with self.metrics.timer('goat_storage_operation_seconds', op=name):
+                return await method(*args, **kwargs)
+        return call
+
+
+class AsyncGoat(Goat):
+
+    """Asyncio variant of :class:`Goat` for async Flask views.
+
+    GitHub calls go through httpx and Redis state through `redis.asyncio`,
+    so no check blocks the event loop. Decorated views
+    may be plain functions or coroutines; the wrappers are always async.
+    """
+
+    def init_app(self, app):
+        Goat.init_app(self, app)
+        self.http = AsyncHTTPClient(**self._http_params(app))
+        self._aflights = {}
+        storage = self.storage
+        if isinstance(storage, MeteredStorage):
+            storage = storage.storage
+        if isinstance(storage, RedisStorage):
+            params = app.config.get('GOAT_REDIS')
+            self._astorage = _LoopLocal(
+                lambda: self._metered(
+                    AsyncRedisStorage(self._connect_async(params))),
+                lambda storage: storage.close())
+        else:
+            local = _LocalStorage(self.storage)
+            self._astorage = _LoopLocal(lambda: local)
+
+    def _ensure_refresher(self):
+        # each view runs on a loop of its own, so there is nothing to run
+        # a background refresher on; call the refresh coroutine from a job
+        pass
+
+    def _connect_async(self, params):
+        options = self._redis_options(params)
+        if params['method'] == 'tcp':
+            return aioredis.Redis(
+                host=params['host'],
+                port=params['port'],
+                db=params['db'],
+                **options)
+        elif params['method'] == 'sentinel':
+            from redis.asyncio.sentinel import Sentinel
+            sentinel = Sentinel(params['sentinels'], **options)
+            return sentinel.master_for(
+                params['service'], db=params.get('db', 0))
+        elif params['method'] == 'cluster':
+            from redis.asyncio.cluster import RedisCluster
+            return RedisCluster(
+                host=params['host'],
+                port=params['port'],
+                **options)
+        return aioredis.Redis(unix_socket_path=params['sock'], **options)
+
+    def _metered(self, storage):
+        if isinstance(self.metrics, NullMetrics):
+            return storage
+        return _MeteredAsyncStorage(storage, self.metrics)
+
+    @property
+    def astorage(self):
+        """The storage client bound to the running event loop.
+        """
+
+        return self._astorage.get()
+
+    async def _read(self, key, loads=None):
+        value = self._local_get(key)
+        if value is not None:
+            return value
+        reads = self._snapshot()
+        if reads is not None and key in reads:
+            value = reads[key]
+        else:
+            value = await self.astorage.get(key)
+        if value is not None and loads is not None:
+            value = loads(value)
+        if value is not None and self.local_cache is not None:
+            self.local_cache.set(key, value)
+        return value
+
+    async def _prefetch(self, keys):
+        reads = g.setdefault('goat_reads', {})
+        missing = [k for k in keys if k not in reads and
+                   (self.local_cache is None or k not in self.local_cache)]
+        if missing:
+            values = await self.astorage.get_many(missing)
+            reads.update(zip(missing, values))
+
+    async def _write(self, key, value, ttl=None):
+        await self._write_many([(key, value, ttl)])
+
+    async def _write_many(self, items):
+        await self.astorage.set_many(items, self._invalidate(
+            [key for key, _, _ in items]))
+
+    async def _delete(self, key):
+        await self.astorage.delete([key], self._invalidate([key]))
+
+    async def _auth_url(self):
+        params = self._auth_params()
+        if not self._signed_state():
+            await self.astorage.set(params['state'], '1', 1000)
+        return Goat.OAUTH + '/authorize?' + urlencode(params)
+
+    async def _verify_state(self, state):
+        params = self._signed_state()
+        if not params:
+            return bool(state) and bool(await self.astorage.get(state))
+        nonce = self._state_nonce(state, params)
+        if nonce is None:
+            return False
+        if params['replay']:
+            return await self.astorage.add(
+                'GOAT_STATE:' + nonce, '1', params['max_age'])
+        return True
+
+    async def _login(self):
+        if 'user' in session:
+            return redirect(url_for('index'))
+        login_page = current_app.config.get('GOAT_LOGIN_PAGE')
+        url = await self._auth_url()
+        if login_page is not None:
+            return render_template(login_page, url=url)
+        return Goat.LOGIN.format(
+            org=current_app.config.get('GOAT_ORGANIZATION'),
+            url=url)
+
+    async def _logout(self):
+        user = session.get('user')
+        if user is not None:
+            await self.invalidate_membership(user)
+        session.clear()
+        return redirect(url_for('login'))
+
+    async def _callback(self):
+        error = request.args.get('error', '')
+        if error:
+            abort(403)
+        if not await self._verify_state(request.args.get('state', '')):
+            abort(403)
+        code = request.args.get('code')
+        try:
+            token = await self.get_token(code)
+            user, member = await self._resolve_login(token)
+            if member:
+                await self._log_in(token, user)
+        except GitHubUnavailable:
+            abort(503)
+        return redirect(url_for('index'))
+
+    async def _log_in(self, token, user):
+        record = self._new_user_record(token)
+        teams = org_teams = None
+        if self._claims_enabled() or \
+                current_app.config.get('GOAT_USER_TEAMS_TTL'):
+            teams = await self._login_teams(token, user)
+        if self._claims_enabled():
+            org_teams = await self._get_org_teams(token)
+        if current_app.config.get('GOAT_USER_TEAMS_TTL'):
+            record['teams'] = self._user_teams_entry(teams)
+        writes = [self._user_write(user, record)]
+        if self.refresh_ahead:
+            writes.append(('GOAT_REFRESH_USER', user, None))
+        await self._write_many(writes)
+        session['user'] = user
+        if self._claims_enabled():
+            self._sign_claim(user, org_teams, teams)
+
+    async def _webhook(self):
+        event, payload = self._webhook_event()
+        if event == 'membership' and payload.get('scope') == 'team':
+            await self.apply_membership(
+                payload['member']['login'],
+                payload['team'],
+                payload.get('action') == 'added')
+        elif event == 'team':
+            await self.apply_team(payload.get('action'), payload['team'],
+                                  payload.get('changes', {}))
+        elif (event == 'organization' and
+                payload.get('action') == 'member_removed'):
+            await self.revoke(payload['membership']['user']['login'])
+        return '', 204
+
+    async def apply_membership(self, username, team, member):
+        tid = team['id']
+        key = self._membership_key(username)
+        entries = await self._read(key, json.loads)
+        ttl = self._membership_ttl(member)
+        if ttl:
+            await self._write(
+                key, *self._merge_membership(entries, tid, member, ttl))
+        elif entries and str(tid) in entries:
+            dropped = self._drop_membership(entries, tid)
+            if dropped is None:
+                await self._delete(key)
+            else:
+                await self._write(key, *dropped)
+
+        record = await self._user_record(username)
+        if record and record.get('teams'):
+            record['teams'] = self._updated_user_teams(
+                record['teams'], tid, member)
+            await self._write(*self._user_write(username, record))
+
+        if member and 'name' in team:
+            await self.apply_team('created', team, {})
+
+    async def apply_team(self, action, team, changes):
+        teams = await self._read('GOAT_TEAMS', json.loads)
+        teams = self._updated_team_map(teams, action, team, changes)
+        if teams is not None:
+            await self._write('GOAT_TEAMS', json.dumps(teams))
+
+    async def refresh(self):
+        """Coroutine counterpart of :func:`Goat.refresh`, e.g. for a
+        scheduled job; AsyncGoat workers do not run the refresher.
+        """
+
+        margin = (self.refresh_ahead or Goat.REFRESH_AHEAD)['margin']
+        deadline = time.time() + margin
+        refresh_user = await self._read('GOAT_REFRESH_USER')
+        if refresh_user is not None:
+            token = await self._user_token(refresh_user.decode('utf-8'))
+            marker = await self.astorage.get('GOAT_TEAMS_REFRESH')
+            if (token and not self._teams_fresh(marker, -margin) and
+                    not await self._conserving(token)):
+                await self._refresh_org_teams(token)
+
+        hot = [self._hot_entry(key) for key in list(
+            await self.astorage.scan(Goat.HOT_PREFIX + '*'))]
+        for key in (k for k in hot if k.startswith('GOAT_MEMBERSHIP:')):
+            username = self._key_user(key)
+            entries = await self._read(
+                self._membership_key(username), json.loads)
+            token = await self._user_token(username)
+            if not entries or not token or await self._conserving(token):
+                continue
+            for tid, entry in entries.items():
+                if entry[1] < deadline:
+                    member = await self._fetch_membership(
+                        token, username, tid)
+                    await self._cache_membership(username, tid, member)
+
+        for key in (k for k in hot if k.startswith('GOAT_USER:')):
+            username = self._key_user(key)
+            record = await self._user_record(username)
+            entry = record.get('teams') if record else None
+            if (entry and entry['expires'] < deadline and
+                    not await self._conserving(record['token'])):
+                await self._store_user_teams(
+                    username, await self.get_user_teams(record['token']))
+
+    async def revoke(self, username):
+        await self._delete(self._membership_key(username))
+        await self._delete(self._user_key(username))
+        await self._delete(username)
+
+    async def _coalesce(self, key, fetch, ready, stale, shared=True):
+        loop = asyncio.get_running_loop()
+        flight = self._aflights.get(key)
+        if flight is not None and flight.get_loop() is loop:
+            try:
+                return await asyncio.shield(flight)
+            except GitHubUnavailable:
+                result = await stale()
+                if result is None:
+                    raise
+                return result
+        flight = self._aflights[key] = loop.create_task(
+            self._coalesce_workers(key, fetch, ready, stale, shared))
+        try:
+            return await asyncio.shield(flight)
+        except GitHubUnavailable:
+            result = await stale()
+            if result is None:
+                raise
+            return result
+        finally:
+            if self._aflights.get(key) is flight:
+                del self._aflights[key]
+
+    async def _coalesce_workers(self, key, fetch, ready, stale, shared=True):
+        params = current_app.config.get('GOAT_COALESCE')
+        if not params or not shared:
+            return await fetch()
+        lock = 'GOAT_LOCK:' + key
+        node = self._node.encode('utf-8')
+        if await self.astorage.add(lock, node, params['lock']):
+            try:
+                return await fetch()
+            finally:
+                if await self.astorage.get(lock) == node:
+                    await self.astorage.delete([lock])
+        deadline = time.time() + params['wait']
+        while time.time() < deadline:
+            await asyncio.sleep(Goat.COALESCE_POLL)
+            result = await ready()
+            if result is not None:
+                return result
+            if await self.astorage.get(lock) is None:
+                break
+        result = await stale()
+        return result if result is not None else await fetch()
+
+    async def _stored(self, key):
+        raw = await self.astorage.get(key)
+        return json.loads(raw) if raw is not None else None
+
+    async def _user_record(self, username):
+        record = await self._read(self._user_key(username), json.loads)
+        if record is not None:
+            return record
+        token = await self._read(username)
+        if token is None:
+            return None
+        record = self._new_user_record(token.decode('utf-8'))
+        await self._write(*self._user_write(username, record))
+        await self._delete(username)
+        return record
+
+    async def _user_token(self, username):
+        record = await self._user_record(username)
+        return record['token'] if record else None
+
+    async def _active_token(self, username):
+        record = await self._user_record(username)
+        if record is None:
+            return None
+        if self._stale_record(record):
+            record['seen'] = time.time()
+            await self._write(*self._user_write(username, record))
+        return record['token']
+
+    async def _github(self, method, url, token=None, **kwargs):
+        path = self._allow_github(url)
+        status = 'error'
+        try:
+            with self.metrics.timer('goat_github_request_seconds',
+                                    endpoint=path):
+                resp = await self.http.request(method, url, **kwargs)
+            status = resp.status_code
+        except httpx.HTTPError as e:
+            self._github_failed(e)
+        finally:
+            self.metrics.inc('goat_github_requests_total',
+                             endpoint=path, status=status)
+        self._github_answered(resp)
+        budget = self._parse_rate_limit(resp)
+        if budget is not None:
+            write = self._rate_limit_write(token, budget)
+            if write is not None:
+                await self.astorage.set(*write)
+        return resp
+
+    async def _conserving(self, token):
+        reserve = current_app.config.get('GOAT_RATELIMIT_RESERVE')
+        if not reserve:
+            return False
+        key = self._rate_limit_key(token)
+        budget = self._rate_limits.get(key, self)
+        if budget is self:
+            raw = await self.astorage.get(key)
+            budget = json.loads(raw) if raw else None
+            self._rate_limits.set(key, budget)
+        return (budget is not None and budget['reset'] >= time.time() and
+                budget['remaining'] < reserve)
+
+    async def get_token(self, code):
+        resp = await self._github(
+            'POST',
+            self._token_url(code),
+            headers={'Accept': 'application/json'}
+        )
+        data = json.loads(resp.text)
+        return data.get('access_token', None)
+
+    async def _resolve_login(self, token):
+        if current_app.config.get('GOAT_GRAPHQL'):
+            viewer = self._graphql_viewer(
+                await self._graphql(token, Goat.GRAPHQL_LOGIN))
+            if viewer is not None:
+                return viewer
+        user = await self.get_username(token)
+        return user, await self.is_org_member(token, user)
+
+    async def _login_teams(self, token, username):
+        if current_app.config.get('GOAT_GRAPHQL'):
+            teams, after = set(), None
+            while True:
+                page = self._graphql_teams(await self._graphql(
+                    token, Goat.GRAPHQL_TEAMS, login=username, after=after))
+                if page is None:
+                    break
+                teams.update(page[0])
+                after = page[1]
+                if after is None:
+                    return teams
+        return await self.get_user_teams(token)
+
+    async def _graphql(self, token, query, **variables):
+        variables['org'] = current_app.config.get('GOAT_ORGANIZATION')
+        resp = await self._github(
+            'POST', Goat.API + '/graphql', token,
+            headers={'Authorization': 'bearer {}'.format(token),
+                     'Accept': 'application/json'},
+            content=json.dumps({'query': query, 'variables': variables}))
+        return self._graphql_data(resp)
+
+    async def get_username(self, token):
+        url = Goat.API + '/user?access_token={}'.format(token)
+        resp = await self._github(
+            'GET', url, token, headers={'Accept': 'application/json'})
+        data = json.loads(resp.text)
+        return data.get('login', None)
+
+    async def get_user_teams(self, token):
+        url = Goat.API + '/user/teams?per_page=100&access_token={}'.format(
+            token)
+        teams = set()
+        while url:
+            resp = await self._github(
+                'GET', url, token, headers={'Accept': 'application/json'})
+            teams.update(self._org_team_ids(json.loads(resp.text)))
+            url = resp.links.get('next', {}).get('url')
+        return teams
+
+    async def _store_user_teams(self, username, teams):
+        record = await self._user_record(username)
+        if record is not None:
+            record['teams'] = self._user_teams_entry(teams)
+            await self._write(*self._user_write(username, record))
+
+    async def _user_teams(self, token, username):
+        if not current_app.config.get('GOAT_USER_TEAMS_TTL') or not token:
+            return None
+        record = await self._user_record(username)
+        entry = record.get('teams') if record else None
+        teams = self._fresh_user_teams(entry)
+        self._count_cache('user_teams', teams is not None)
+        if teams is not None:
+            await self._mark_hot(self._user_key(username), entry['expires'])
+        if teams is None and entry and await self._conserving(token):
+            teams = self._fresh_user_teams(entry, fallback=True)
+        if teams is not None:
+            return teams
+
+        key = self._user_key(username)
+
+        async def fetch():
+            teams = await self.get_user_teams(token)
+            await self._store_user_teams(username, teams)
+            return teams
+
+        async def ready():
+            return self._fresh_user_teams(
+                (await self._stored(key) or {}).get('teams'))
+
+        async def stale():
+            return self._fresh_user_teams(entry, fallback=True)
+
+        return await self._coalesce(key + ':teams', fetch, ready, stale)
+
+    async def _get_org_teams(self, token):
+        teams = await self._read('GOAT_TEAMS', json.loads)
+        marker = await self._read('GOAT_TEAMS_REFRESH')
+        if teams is not None and (
+                self._teams_fresh(marker, self._stale_window()) or
+                await self._conserving(token)):
+            return teams
+
+        async def ready():
+            marker = await self.astorage.get('GOAT_TEAMS_REFRESH')
+            if self._teams_fresh(marker):
+                return await self._stored('GOAT_TEAMS')
+
+        async def stale():
+            return teams
+
+        return await self._coalesce(
+            'GOAT_TEAMS', lambda: self._refresh_org_teams(token),
+            ready, stale)
+
+    async def _refresh_org_teams(self, token):
+        pages = await self._read('GOAT_TEAMS_PAGES', json.loads) or []
+        fetched = []
+        changed = False
+        while True:
+            old = pages[len(fetched)] if len(fetched) < len(pages) else None
+            resp = await self._github(
+                'GET',
+                self._org_teams_url(token, len(fetched) + 1),
+                token,
+                headers=self._team_page_headers(old))
+            page = self._team_page(resp, old)
+            changed = changed or page is not old
+            fetched.append(page)
+            if not page['next']:
+                break
+        changed = changed or len(fetched) != len(pages)
+
+        teams = self._merge_team_pages(fetched)
+        if changed:
+            await self._write('GOAT_TEAMS', json.dumps(teams))
+            await self._write('GOAT_TEAMS_PAGES', json.dumps(fetched))
+        await self._write(*self._teams_marker())
+        return teams
+
+    async def is_org_member(self, token, username):
+        org = current_app.config.get('GOAT_ORGANIZATION')
+        url = '/orgs/{}/members/{}'.format(org, username)
+        resp = await self._github('GET', Goat.API + url)
+        return resp.status_code == 204
+
+    async def is_team_member(self, token, username, team):
+        teams = await self._get_org_teams(token)
+        tid = teams.get(team, None)
+        if not tid:
+            return False
+
+        cached = await self._cached_membership(
+            username, tid, await self._conserving(token))
+        if cached is not None:
+            return cached
+
+        async def fetch():
+            member = await self._fetch_membership(token, username, tid)
+            await self._cache_membership(username, tid, member)
+            return member
+
+        key = self._membership_key(username)
+
+        async def ready():
+            return self._membership_hit(await self._stored(key), tid)
+
+        async def stale():
+            return await self._cached_membership(username, tid, fallback=True)
+
+        return await self._coalesce(
+            '{}:{}'.format(key, tid), fetch, ready, stale,
+            self._cache_enabled())
+
+    async def _fetch_membership(self, token, username, tid):
+        resp = await self._github(
+            'GET', self._team_membership_url(tid, username, token), token)
+        return resp.status_code == 200
+
+    async def _cached_membership(self, username, tid, fallback=False):
+        if not self._cache_enabled():
+            return None
+        key = self._membership_key(username)
+        entries = await self._read(key, json.loads)
+        member = self._membership_hit(entries, tid, fallback)
+        if member is not None:
+            await self._mark_hot(key, entries[str(tid)][1])
+        return member
+
+    async def _mark_hot(self, key, expires):
+        write = self._hot_write(key, expires)
+        if write is not None:
+            await self.astorage.set(*write)
+
+    async def _cache_membership(self, username, tid, member):
+        ttl = self._membership_ttl(member)
+        if not ttl:
+            return
+        key = self._membership_key(username)
+        entries = await self._read(key, json.loads)
+        await self._write(
+            key, *self._merge_membership(entries, tid, member, ttl))
+
+    async def access_matrix(self, token, users, teams, cache=False):
+        tids = self._matrix_teams(await self._get_org_teams(token), teams)
+        wanted = sorted(set(t for t in tids.values() if t))
+        members = await asyncio.gather(
+            *[self._team_logins(token, tid) for tid in wanted])
+        members = dict(zip(wanted, members))
+        matrix = self._matrix(users, tids, members)
+        if cache and self._membership_ttl(True):
+            positives = self._matrix_positives(matrix, tids, members)
+            keys = [self._membership_key(login) for login in positives]
+            writes = self._matrix_writes(
+                positives, keys, await self.astorage.get_many(keys))
+            if writes:
+                await self._write_many(writes)
+        return matrix
+
+    async def get_team_members(self, token, tid):
+        return set(await self._team_logins(token, tid))
+
+    async def _team_logins(self, token, tid):
+        url = self._team_members_url(token, tid)
+        logins = {}
+        while url:
+            resp = await self._github(
+                'GET', url, token, headers={'Accept': 'application/json'})
+            logins.update(self._member_logins(resp))
+            url = resp.links.get('next', {}).get('url')
+        return logins
+
+    async def invalidate_membership(self, username):
+        await self._delete(self._membership_key(username))
+        record = await self._user_record(username)
+        if record and record.get('teams'):
+            record['teams'] = None
+            await self._write(*self._user_write(username, record))
+
+    async def _check_teams(self, token, username, teams, require_all=True):
+        team_ids = await self._user_teams(token, username)
+        if team_ids is not None:
+            org_teams = await self._get_org_teams(token)
+            return self._match_teams(org_teams, team_ids, teams, require_all)
+
+        if len(teams) < 2:
+            for team in teams:
+                member = await self.is_team_member(token, username, team)
+                if member != require_all:
+                    return not require_all
+            return require_all
+
+        # load the team map once rather than once per task
+        await self._get_org_teams(token)
+        tasks = [asyncio.ensure_future(
+            self.is_team_member(token, username, team)) for team in teams]
+        try:
+            for future in asyncio.as_completed(tasks):
+                if await future != require_all:
+                    return not require_all
+            return require_all
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _check_policy(self, token, username, policy):
+        org_teams = await self._get_org_teams(token)
+        team_ids = await self._user_teams(token, username)
+        if team_ids is None:
+            team_ids = set()
+            for team, tid in zip(policy.teams, policy.ids(org_teams)):
+                if tid is not None and await self.is_team_member(
+                        token, username, team):
+                    team_ids.add(tid)
+        return policy.allows(policy.mask(org_teams, team_ids))
+
+    async def _issue_claim(self, username):
+        token = await self._active_token(username)
+        if not token:
+            session.pop('goat_claim', None)
+            return None
+        team_ids = await self._user_teams(token, username)
+        if team_ids is None:
+            team_ids = await self.get_user_teams(token)
+        return self._sign_claim(
+            username, await self._get_org_teams(token), team_ids)
+
+    def _protect(self, check, match):
+        def wrapper(f):
+            @wraps(f)
+            async def wrapped(*args, **kwargs):
+                if 'user' not in session:
+                    self._count_decision('login')
+                    return redirect(url_for('login'))
+                user = session['user']
+                with self.metrics.timer('goat_decision_seconds',
+                                        view=request.endpoint):
+                    try:
+                        if self._claims_enabled():
+                            teams = self._claim(user)
+                            if teams is None:
+                                await self._prefetch(self._auth_keys(user))
+                                teams = await self._issue_claim(user)
+                            allowed = teams is not None and \
+                                match(teams, set(teams.values()))
+                        else:
+                            await self._prefetch(self._auth_keys(user))
+                            allowed = await check(
+                                await self._active_token(user), user)
+                    except GitHubUnavailable:
+                        self._count_decision('unavailable')
+                        abort(503)
+                self._count_decision('allow' if allowed else 'deny')
+                if not allowed:
+                    abort(403)
+                with self.metrics.timer('goat_view_seconds',
+                                        view=request.endpoint):
+                    if iscoroutinefunction(f):
+                        return await f(*args, **kwargs)
+                    return f(*args, **kwargs)
+            return wrapped
+        return wrapper
@@ -0,0 +1,104 @@
+import time
+import threading
+
+
+class GitHubUnavailable(Exception):
+
+    """GitHub could not be reached or did not give a usable answer.
+    """
+
+
+class CircuitOpen(GitHubUnavailable):
+
+    """The circuit breaker is failing calls fast while GitHub recovers.
+    """
+
+
+class CircuitBreaker(object):
+
+    """Stops calling GitHub after repeated failures.
+
+    After `failures` consecutive failures the circuit opens and calls are
+    refused for `reset` seconds. It then turns half-open and lets up to
+    `probes` calls through at a time: a success closes the circuit, a
+    failure opens it again. `listener`, if given, is called with the new
+    state on every transition.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failures=5, reset=30, probes=1, listener=None):
+        self.failures = failures
+        self.reset = reset
+        self.probes = probes
+        self.listener = listener
+        self._state = CircuitBreaker.CLOSED
+        self._failed = 0
+        self._opened_at = None
+        self._probing = 0
+        self._trips = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current()
+
+    def _current(self):
+        if (self._state == CircuitBreaker.OPEN and
+                self._opened_at + self.reset <= time.time()):
+            self._move(CircuitBreaker.HALF_OPEN)
+        return self._state
+
+    def _move(self, state):
+        self._state = state
+        if state == CircuitBreaker.OPEN:
+            self._opened_at = time.time()
+            self._trips += 1
+        self._probing = 0
+        if self.listener is not None:
+            self.listener(state)
+
+    def allow(self):
+        """Returns True if a call may go ahead. Every allowed call must
+        be followed by :func:`success` or :func:`failure`.
+        """
+
+        with self._lock:
+            state = self._current()
+            if state == CircuitBreaker.CLOSED:
+                return True
+            if state == CircuitBreaker.HALF_OPEN and \
+                    self._probing < self.probes:
+                self._probing += 1
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self._failed = 0
+            if self._state != CircuitBreaker.CLOSED:
+                self._move(CircuitBreaker.CLOSED)
+
+    def failure(self):
+        with self._lock:
+            self._failed += 1
+            if self._state == CircuitBreaker.HALF_OPEN or (
+                    self._state == CircuitBreaker.CLOSED and
+                    self._failed >= self.failures):
+                self._move(CircuitBreaker.OPEN)
+
+    def stats(self):
+        with self._lock:
+            state = self._current()
+            retry = None
+            if state == CircuitBreaker.OPEN:
+                retry = max(self._opened_at + self.reset - time.time(), 0)
+            return {
+                'state': state,
+                'failures': self._failed,
+                'trips': self._trips,
+                'retry_in': retry,
+            }
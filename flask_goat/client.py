@@ -0,0 +1,81 @@
+import os
+import threading
+
+
+class HTTPClient(object):
+
+    """Pooled, keep-alive HTTP client for talking to GitHub.
+
+    Connections are reused across calls through a `requests.Session`.
+    Every call gets connect and read timeouts, and idempotent requests are
+    retried with exponential backoff on connection errors and 5xx
+    responses. The session is created on first use and rebuilt in a forked
+    child so that pre-fork servers never share sockets between workers;
+    `requests` itself is not imported until then.
+    """
+
+    RETRY_STATUSES = (500, 502, 503, 504)
+
+    def __init__(self, pool_size=10, connect_timeout=3.05, read_timeout=10,
+                 retries=3, backoff=0.3):
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self._lock = threading.Lock()
+        self._pid = None
+        self._session = None
+
+    @property
+    def session(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._session = self._create_session()
+                    self._pid = os.getpid()
+        return self._session
+
+    @property
+    def errors(self):
+        """The exception raised when a call fails to get an answer.
+        """
+
+        import requests
+        return requests.RequestException
+
+    def _create_session(self):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from requests.packages.urllib3.util.retry import Retry
+
+        retry = Retry(
+            total=self.retries,
+            backoff_factor=self.backoff,
+            status_forcelist=self.RETRY_STATUSES,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=2,
+            pool_maxsize=self.pool_size,
+            max_retries=retry,
+        )
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def close(self):
+        if self._session is not None and self._pid == os.getpid():
+            self._session.close()
+        self._session = None
+        self._pid = None
@@ -0,0 +1,243 @@
+import time
+import threading
+from .storage import Storage
+
+try:
+    from urlparse import urlparse
+except:
+    from urllib.parse import urlparse
+
+
+class Metrics(object):
+
+    """Per-process counters, gauges and latency histograms.
+
+    Series are named as in Prometheus and told apart by keyword labels.
+    :func:`render` produces the Prometheus text exposition format.
+    """
+
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+               1, 2.5, 5, 10)
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(sorted(buckets or Metrics.BUCKETS))
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def _series(self, name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        series = self._series(name, labels)
+        with self._lock:
+            self._counters[series] = self._counters.get(series, 0) + value
+
+    def set(self, name, value, **labels):
+        series = self._series(name, labels)
+        with self._lock:
+            self._gauges[series] = value
+
+    def observe(self, name, value, **labels):
+        series = self._series(name, labels)
+        with self._lock:
+            hist = self._histograms.get(series)
+            if hist is None:
+                hist = self._histograms[series] = \
+                    [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    hist[0][i] += 1
+                    break
+            hist[1] += value
+            hist[2] += 1
+
+    def timer(self, name, **labels):
+        """Context manager observing the seconds its block takes.
+        """
+
+        return _Timer(self, name, labels)
+
+    def counter(self, name, **labels):
+        with self._lock:
+            return self._counters.get(self._series(name, labels), 0)
+
+    def gauge(self, name, **labels):
+        with self._lock:
+            return self._gauges.get(self._series(name, labels))
+
+    def histogram(self, name, **labels):
+        """Returns the series' count, sum and cumulative bucket counts.
+        """
+
+        with self._lock:
+            hist = self._histograms.get(self._series(name, labels))
+            if hist is None:
+                return {'count': 0, 'sum': 0.0, 'buckets': {}}
+            counts, total, count = hist[0][:], hist[1], hist[2]
+        buckets, seen = {}, 0
+        for bound, n in zip(self.buckets, counts):
+            seen += n
+            buckets[bound] = seen
+        return {'count': count, 'sum': total, 'buckets': buckets}
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+
+    def render(self):
+        with self._lock:
+            counters = sorted(self._counters.items())
+            gauges = sorted(self._gauges.items())
+            histograms = sorted((k, (v[0][:], v[1], v[2]))
+                                for k, v in self._histograms.items())
+        lines = []
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE {} counter'.format(name))
+            lines.append('{}{} {}'.format(name, _labels(labels), value))
+        for (name, labels), value in gauges:
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE {} gauge'.format(name))
+            lines.append('{}{} {}'.format(name, _labels(labels), value))
+        for (name, labels), (counts, total, count) in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE {} histogram'.format(name))
+            seen = 0
+            for bound, n in zip(self.buckets, counts):
+                seen += n
+                lines.append('{}_bucket{} {}'.format(
+                    name, _labels(labels + (('le', repr(float(bound))),)),
+                    seen))
+            lines.append('{}_bucket{} {}'.format(
+                name, _labels(labels + (('le', '+Inf'),)), count))
+            lines.append('{}_sum{} {}'.format(name, _labels(labels), total))
+            lines.append('{}_count{} {}'.format(name, _labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+
+class NullMetrics(Metrics):
+
+    """Discards everything; used while GOAT_METRICS is unset.
+    """
+
+    def inc(self, name, value=1, **labels):
+        pass
+
+    def set(self, name, value, **labels):
+        pass
+
+    def observe(self, name, value, **labels):
+        pass
+
+
+class _Timer(object):
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.time() - self.start,
+                             **self.labels)
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(k, v.replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in labels))
+
+
+ENDPOINT_PARAMS = {
+    'orgs': '{org}',
+    'teams': '{team}',
+    'members': '{user}',
+    'memberships': '{user}',
+}
+
+
+def endpoint(url):
+    """The GitHub endpoint of a URL with its identifiers templated out,
+    e.g. `/teams/{team}/memberships/{user}`.
+    """
+
+    parts = urlparse(url).path.strip('/').split('/')
+    for i in range(1, len(parts)):
+        param = ENDPOINT_PARAMS.get(parts[i - 1])
+        if param is not None and parts[i] != param:
+            parts[i] = param
+    return '/' + '/'.join(parts)
+
+
+class MeteredStorage(Storage):
+
+    """Times every operation of another backend in
+    `goat_storage_operation_seconds`.
+    """
+
+    def __init__(self, storage, metrics):
+        self.storage = storage
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+    @property
+    def broadcasts(self):
+        return self.storage.broadcasts
+
+    def _timed(self, op):
+        return self.metrics.timer('goat_storage_operation_seconds', op=op)
+
+    def get(self, key):
+        with self._timed('get'):
+            return self.storage.get(key)
+
+    def get_many(self, keys):
+        with self._timed('get_many'):
+            return self.storage.get_many(keys)
+
+    def set(self, key, value, ttl=None):
+        with self._timed('set'):
+            return self.storage.set(key, value, ttl)
+
+    def set_many(self, items, channel=None):
+        with self._timed('set_many'):
+            return self.storage.set_many(items, channel)
+
+    def delete(self, keys, channel=None):
+        with self._timed('delete'):
+            return self.storage.delete(keys, channel)
+
+    def add(self, key, value, ttl):
+        with self._timed('add'):
+            return self.storage.add(key, value, ttl)
+
+    def expire(self, key, ttl):
+        with self._timed('expire'):
+            return self.storage.expire(key, ttl)
+
+    def ttl(self, key):
+        with self._timed('ttl'):
+            return self.storage.ttl(key)
+
+    def scan(self, pattern):
+        with self._timed('scan'):
+            return iter(list(self.storage.scan(pattern)))
+
+    def listen(self, channel):
+        return self.storage.listen(channel)
@@ -0,0 +1,156 @@
+class Policy(object):
+
+    """Boolean expression over team memberships.
+
+    Combine teams with `&`, `|` and `~`. Plain team names may appear on
+    either side of an operator as long as one operand is a Policy:
+
+        Team('Owners') | ('ReadWrite' & ~Team('Contractors'))
+    """
+
+    def __and__(self, other):
+        return All(self, other)
+
+    def __rand__(self, other):
+        return All(other, self)
+
+    def __or__(self, other):
+        return Any(self, other)
+
+    def __ror__(self, other):
+        return Any(other, self)
+
+    def __invert__(self):
+        return Not(self)
+
+    def teams(self):
+        """Team names in the order they first appear.
+        """
+
+        raise NotImplementedError
+
+    def evaluate(self, mask, index):
+        """Evaluates the policy for a bitset of team memberships, where
+        `index` maps each team name to its bit.
+        """
+
+        raise NotImplementedError
+
+    def compile(self):
+        return CompiledPolicy(self)
+
+
+def _policy(value):
+    if isinstance(value, Policy):
+        return value
+    if isinstance(value, (type(''), type(u''))):
+        return Team(value)
+    raise TypeError('invalid policy: {!r}'.format(value))
+
+
+class Team(Policy):
+
+    def __init__(self, name):
+        self.name = name
+
+    def teams(self):
+        return [self.name]
+
+    def evaluate(self, mask, index):
+        return bool(mask >> index[self.name] & 1)
+
+    def __repr__(self):
+        return 'Team({!r})'.format(self.name)
+
+
+class All(Policy):
+
+    def __init__(self, *operands):
+        self.operands = [_policy(op) for op in operands]
+
+    def teams(self):
+        names = []
+        for op in self.operands:
+            names.extend(n for n in op.teams() if n not in names)
+        return names
+
+    def evaluate(self, mask, index):
+        return all(op.evaluate(mask, index) for op in self.operands)
+
+    def __repr__(self):
+        return '({})'.format(' & '.join(map(repr, self.operands)))
+
+
+class Any(All):
+
+    def evaluate(self, mask, index):
+        return any(op.evaluate(mask, index) for op in self.operands)
+
+    def __repr__(self):
+        return '({})'.format(' | '.join(map(repr, self.operands)))
+
+
+class Not(Policy):
+
+    def __init__(self, operand):
+        self.operand = _policy(operand)
+
+    def teams(self):
+        return self.operand.teams()
+
+    def evaluate(self, mask, index):
+        return not self.operand.evaluate(mask, index)
+
+    def __repr__(self):
+        return '~{!r}'.format(self.operand)
+
+
+class CompiledPolicy(object):
+
+    """A policy reduced to a truth table over its teams.
+
+    Bit `i` of a membership mask is set when the user is on the `i`-th
+    team of `teams`; the policy allows the mask when bit `mask` of the
+    table is set. Policies over more than TABLE_TEAMS teams keep their
+    expression tree instead. Team ids are resolved once per loaded team
+    map rather than on every check.
+    """
+
+    TABLE_TEAMS = 12
+
+    def __init__(self, policy):
+        self.policy = _policy(policy)
+        self.teams = tuple(self.policy.teams())
+        self.index = dict((name, i) for i, name in enumerate(self.teams))
+        self.table = None
+        if len(self.teams) <= self.TABLE_TEAMS:
+            self.table = 0
+            for mask in range(1 << len(self.teams)):
+                if self.policy.evaluate(mask, self.index):
+                    self.table |= 1 << mask
+        self._bound = (None, ())
+
+    def ids(self, org_teams):
+        """Team ids in bit order, None for teams missing from the map.
+        """
+
+        bound_map, ids = self._bound
+        if bound_map is not org_teams:
+            ids = tuple(org_teams.get(name) for name in self.teams)
+            self._bound = (org_teams, ids)
+        return ids
+
+    def mask(self, org_teams, team_ids):
+        mask = 0
+        for i, tid in enumerate(self.ids(org_teams)):
+            if tid is not None and tid in team_ids:
+                mask |= 1 << i
+        return mask
+
+    def allows(self, mask):
+        if self.table is not None:
+            return bool(self.table >> mask & 1)
+        return self.policy.evaluate(mask, self.index)
+
+    def __repr__(self):
+        return 'CompiledPolicy({!r})'.format(self.policy)
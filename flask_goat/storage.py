@@ -0,0 +1,346 @@
+import os
+import time
+import sqlite3
+import threading
+from fnmatch import fnmatchcase
+from collections import OrderedDict
+
+
+def _encode(value):
+    if isinstance(value, bytes):
+        return value
+    if not isinstance(value, type(u'')):
+        value = str(value)
+    return value.encode('utf-8')
+
+
+class Storage(object):
+
+    """Key-value store for OAuth state, tokens, team maps and caches.
+
+    Values are written as strings and read back as bytes, mirroring Redis.
+    Writes may name a channel on which the written keys are announced so
+    that other workers can evict their local copies; backends that do not
+    span processes ignore it.
+    """
+
+    broadcasts = False
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def get_many(self, keys):
+        return [self.get(key) for key in keys]
+
+    def set(self, key, value, ttl=None):
+        self.set_many([(key, value, ttl)])
+
+    def set_many(self, items, channel=None):
+        """Writes `(key, value, ttl)` triples in a single round-trip.
+        """
+
+        raise NotImplementedError
+
+    def delete(self, keys, channel=None):
+        raise NotImplementedError
+
+    def add(self, key, value, ttl):
+        """Sets the key only if it does not exist. Returns True if it was set.
+        """
+
+        raise NotImplementedError
+
+    def expire(self, key, ttl):
+        raise NotImplementedError
+
+    def ttl(self, key):
+        """Seconds until the key expires: 0 if it is missing, None if it
+        never expires.
+        """
+
+        raise NotImplementedError
+
+    def scan(self, pattern):
+        """Iterates over the keys matching a glob-style pattern.
+        """
+
+        raise NotImplementedError
+
+    def listen(self, channel):
+        """Yields keys announced on the channel by other workers.
+        Only called on backends that set `broadcasts`.
+        """
+
+        raise NotImplementedError
+
+
+class RedisStorage(Storage):
+
+    """Storage on a Redis server, Sentinel master or Redis Cluster.
+
+    Given a `connect` function rather than a connection, the client is
+    created on first use in each process, so that pre-fork servers never
+    share one between workers.
+    """
+
+    broadcasts = True
+
+    def __init__(self, connection=None, connect=None):
+        self._connection = connection
+        self._connect = connect
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def connection(self):
+        if self._connect is not None and self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._connection = self._connect()
+                    self._pid = os.getpid()
+        return self._connection
+
+    def get(self, key):
+        return self.connection.get(key)
+
+    def get_many(self, keys):
+        # a cluster splits the keys by slot; per-user keys share one
+        mget = getattr(self.connection, 'mget_nonatomic',
+                       self.connection.mget)
+        return mget(keys)
+
+    @property
+    def _cluster(self):
+        return hasattr(self.connection, 'get_default_node')
+
+    def set_many(self, items, channel=None):
+        cluster = self._cluster
+        pipe = self.connection.pipeline(transaction=False)
+        for key, value, ttl in items:
+            pipe.set(key, value, ex=ttl)
+            if channel is not None and not cluster:
+                pipe.publish(channel, key)
+        pipe.execute()
+        if channel is not None and cluster:
+            self._publish(channel, [key for key, _, _ in items])
+
+    def delete(self, keys, channel=None):
+        cluster = self._cluster
+        pipe = self.connection.pipeline(transaction=False)
+        if cluster:
+            # cluster pipelines refuse commands spanning several slots
+            for key in keys:
+                pipe.delete(key)
+        else:
+            pipe.delete(*keys)
+            if channel is not None:
+                for key in keys:
+                    pipe.publish(channel, key)
+        pipe.execute()
+        if channel is not None and cluster:
+            self._publish(channel, keys)
+
+    def _publish(self, channel, keys):
+        """Announces keys on a Redis Cluster, whose pipelines refuse
+        PUBLISH: through a pipeline on one node, since cluster pub/sub
+        forwards every message to all nodes.
+        """
+
+        node = self.connection.get_default_node()
+        pipe = self.connection.get_redis_connection(node).pipeline(
+            transaction=False)
+        for key in keys:
+            pipe.publish(channel, key)
+        pipe.execute()
+
+    def add(self, key, value, ttl):
+        return bool(self.connection.set(key, value, nx=True, ex=ttl))
+
+    def expire(self, key, ttl):
+        self.connection.expire(key, ttl)
+
+    def ttl(self, key):
+        ttl = self.connection.ttl(key)
+        if ttl == -1:
+            return None
+        return max(ttl, 0)
+
+    def scan(self, pattern):
+        return self.connection.scan_iter(pattern)
+
+    def listen(self, channel):
+        pubsub = self.connection.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(channel)
+        for message in pubsub.listen():
+            key = message['data']
+            if isinstance(key, bytes):
+                key = key.decode('utf-8')
+            yield key
+
+
+class MemoryStorage(Storage):
+
+    """Thread-safe in-process storage with per-key expiry.
+
+    Suited to single-process deployments and tests. Once `maxsize` keys
+    are held the least recently used ones are evicted.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def _live(self, key, now):
+        entry = self._data.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= now:
+            del self._data[key]
+            return None
+        return entry
+
+    def get(self, key):
+        with self._lock:
+            entry = self._live(key, time.time())
+            if entry is None:
+                return None
+            self._data[key] = self._data.pop(key)
+            return entry[0]
+
+    def set_many(self, items, channel=None):
+        now = time.time()
+        with self._lock:
+            for key, value, ttl in items:
+                self._data.pop(key, None)
+                expires = now + ttl if ttl else None
+                self._data[key] = (_encode(value), expires)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, keys, channel=None):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def add(self, key, value, ttl):
+        with self._lock:
+            if self._live(key, time.time()) is not None:
+                return False
+            self.set(key, value, ttl)
+            return True
+
+    def expire(self, key, ttl):
+        with self._lock:
+            entry = self._live(key, time.time())
+            if entry is not None:
+                self._data[key] = (entry[0], time.time() + ttl)
+
+    def ttl(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._live(key, now)
+        if entry is None:
+            return 0
+        if entry[1] is None:
+            return None
+        return int(entry[1] - now)
+
+    def scan(self, pattern):
+        now = time.time()
+        with self._lock:
+            keys = [k for k in list(self._data)
+                    if fnmatchcase(k, pattern) and self._live(k, now)]
+        return iter(keys)
+
+
+class SQLiteStorage(Storage):
+
+    """Storage in a local SQLite file shared by the workers of one host.
+
+    Each thread of each process opens its own connection; the database
+    runs in WAL mode so readers do not block the writer.
+    """
+
+    PURGE_EVERY = 1000
+
+    def __init__(self, path, timeout=5):
+        self.path = path
+        self.timeout = timeout
+        self._writes = 0
+        self._local = threading.local()
+        with self._connection() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS goat '
+                       '(key TEXT PRIMARY KEY, value BLOB, expires REAL)')
+
+    def _connection(self):
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            local.db = sqlite3.connect(self.path, timeout=self.timeout)
+            local.db.execute('PRAGMA journal_mode=WAL')
+            local.pid = os.getpid()
+        return local.db
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def get_many(self, keys):
+        rows = self._connection().execute(
+            'SELECT key, value FROM goat WHERE key IN ({}) AND '
+            '(expires IS NULL OR expires > ?)'.format(
+                ','.join('?' * len(keys))),
+            list(keys) + [time.time()])
+        found = dict((k, bytes(v)) for k, v in rows)
+        return [found.get(key) for key in keys]
+
+    def set_many(self, items, channel=None):
+        now = time.time()
+        rows = [(key, _encode(value), now + ttl if ttl else None)
+                for key, value, ttl in items]
+        with self._connection() as db:
+            db.executemany('INSERT OR REPLACE INTO goat VALUES (?, ?, ?)', rows)
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            self.purge()
+
+    def delete(self, keys, channel=None):
+        with self._connection() as db:
+            db.executemany('DELETE FROM goat WHERE key = ?',
+                           [(key,) for key in keys])
+
+    def add(self, key, value, ttl):
+        now = time.time()
+        with self._connection() as db:
+            db.execute('DELETE FROM goat WHERE key = ? AND expires <= ?',
+                       (key, now))
+            cursor = db.execute(
+                'INSERT OR IGNORE INTO goat VALUES (?, ?, ?)',
+                (key, _encode(value), now + ttl))
+            return cursor.rowcount == 1
+
+    def expire(self, key, ttl):
+        with self._connection() as db:
+            db.execute('UPDATE goat SET expires = ? WHERE key = ?',
+                       (time.time() + ttl, key))
+
+    def ttl(self, key):
+        now = time.time()
+        row = self._connection().execute(
+            'SELECT expires FROM goat WHERE key = ? AND '
+            '(expires IS NULL OR expires > ?)', (key, now)).fetchone()
+        if row is None:
+            return 0
+        if row[0] is None:
+            return None
+        return int(row[0] - now)
+
+    def scan(self, pattern):
+        rows = self._connection().execute(
+            'SELECT key FROM goat WHERE key GLOB ? AND '
+            '(expires IS NULL OR expires > ?)', (pattern, time.time()))
+        return iter([row[0] for row in rows])
+
+    def purge(self):
+        """Deletes expired rows; SQLite does not expire them on its own.
+        """
+
+        with self._connection() as db:
+            db.execute('DELETE FROM goat WHERE expires <= ?', (time.time(),))
@@ -0,0 +1,128 @@
+import threading
+from flask import g, has_app_context
+from flask.signals import Namespace
+from .metrics import Metrics
+
+signals = Namespace()
+
+#: Sent after each traced request that did authorization work, with the
+#: :class:`Trace` as `trace` and the outgoing `response`.
+request_traced = signals.signal('goat-request-traced')
+
+
+def current_trace():
+    """The trace of the current request, if it is being traced.
+    """
+
+    return g.get('goat_trace') if has_app_context() else None
+
+
+class Trace(object):
+
+    """Authorization work done while serving one request.
+
+    `events` holds `(kind, name, seconds)` for each decorator check
+    (`auth`), decorated view (`view`), GitHub call (`github`) and storage
+    operation (`storage`), and `(kind, name, result)` for each cache
+    lookup (`cache`), in the order they finished.
+    """
+
+    KINDS = ('auth', 'view', 'github', 'storage')
+
+    def __init__(self):
+        self.events = []
+        self._lock = threading.Lock()
+
+    def add(self, kind, name, value):
+        with self._lock:
+            self.events.append((kind, name, value))
+
+    def totals(self):
+        """Returns `{kind: (count, seconds)}` for the timed kinds.
+        """
+
+        totals = {}
+        with self._lock:
+            events = self.events[:]
+        for kind, name, value in events:
+            if kind in Trace.KINDS:
+                count, seconds = totals.get(kind, (0, 0.0))
+                totals[kind] = (count + 1, seconds + value)
+        return totals
+
+    def cache_results(self):
+        """Returns the number of cache hits and misses.
+        """
+
+        with self._lock:
+            results = [e[2] for e in self.events if e[0] == 'cache']
+        return results.count('hit'), results.count('miss')
+
+    def server_timing(self):
+        """The trace as a `Server-Timing` header value, in milliseconds.
+        """
+
+        totals = self.totals()
+        parts = []
+        for kind in Trace.KINDS:
+            if kind in totals:
+                count, seconds = totals[kind]
+                parts.append('goat-{};dur={:.3f};desc="{} {}"'.format(
+                    kind, seconds * 1000, count,
+                    'call' if count == 1 else 'calls'))
+        hits, misses = self.cache_results()
+        if hits or misses:
+            parts.append('goat-cache;desc="{} hits, {} misses"'.format(
+                hits, misses))
+        return ', '.join(parts)
+
+
+class TracingMetrics(Metrics):
+
+    """Passes everything on to another :class:`Metrics` and adds Goat's
+    timings and cache lookups to the current request's trace.
+    """
+
+    TRACED = {
+        'goat_decision_seconds': ('auth', 'view'),
+        'goat_view_seconds': ('view', 'view'),
+        'goat_github_request_seconds': ('github', 'endpoint'),
+        'goat_storage_operation_seconds': ('storage', 'op'),
+    }
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.buckets = metrics.buckets
+
+    def inc(self, name, value=1, **labels):
+        self.metrics.inc(name, value, **labels)
+        if name == 'goat_cache_total':
+            trace = current_trace()
+            if trace is not None:
+                trace.add('cache', labels['cache'], labels['result'])
+
+    def set(self, name, value, **labels):
+        self.metrics.set(name, value, **labels)
+
+    def observe(self, name, value, **labels):
+        self.metrics.observe(name, value, **labels)
+        traced = TracingMetrics.TRACED.get(name)
+        if traced is not None:
+            trace = current_trace()
+            if trace is not None:
+                trace.add(traced[0], labels[traced[1]], value)
+
+    def counter(self, name, **labels):
+        return self.metrics.counter(name, **labels)
+
+    def gauge(self, name, **labels):
+        return self.metrics.gauge(name, **labels)
+
+    def histogram(self, name, **labels):
+        return self.metrics.histogram(name, **labels)
+
+    def clear(self):
+        self.metrics.clear()
+
+    def render(self):
+        return self.metrics.render()
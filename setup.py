@@ -30,10 +30,14 @@ setup(
     ],
     install_requires=[
         'Flask',
+        'futures; python_version < "3"',
         'redis',
         'simplejson',
         'requests',
     ],
+    extras_require={
+        'async': ['Flask[async]', 'httpx', 'redis>=4.2'],
+    },
     classifiers=[
         'Environment :: Web Environment',
         'Intended Audience :: Developers',
@@ -0,0 +1,169 @@
+import gc
+import time
+import asyncio
+import unittest
+from simplejson import dumps, loads
+from flask import Flask, session
+
+try:
+    import httpx
+    from flask_goat import Goat, Team
+    from flask_goat.aio import AsyncGoat, AsyncHTTPClient
+except ImportError:
+    httpx = None
+
+
+def github(members):
+
+    def handler(request):
+        path = request.url.path
+        if path.startswith('/orgs/') and path.endswith('/teams'):
+            return httpx.Response(200, content=dumps([
+                {'name': 'team1', 'id': 1},
+                {'name': 'team2', 'id': 2},
+            ]))
+        if path.startswith('/orgs/'):
+            return httpx.Response(204)
+        if path.startswith('/teams/'):
+            tid = int(path.split('/')[2])
+            return httpx.Response(200 if tid in members else 404)
+        if path == '/login/oauth/access_token':
+            return httpx.Response(200, json={'access_token': 'usertoken'})
+        if path == '/user':
+            return httpx.Response(200, json={'login': 'username'})
+        return httpx.Response(404)
+
+    return httpx.MockTransport(handler)
+
+
+@unittest.skipIf(httpx is None, 'async dependencies are not installed')
+class TestAsyncGoat(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.secret_key = "secret"
+        self.app.config.setdefault('GOAT_CLIENT_ID', 'publicid')
+        self.app.config.setdefault('GOAT_CLIENT_SECRET', 'secretid')
+        self.app.config.setdefault('GOAT_ORGANIZATION', 'organization')
+        self.app.config.setdefault('GOAT_CALLBACK', 'https://x.com/callback')
+        self.goat = AsyncGoat(self.app)
+        self.goat.redis_connection.delete('GOAT_TEAMS')
+        self.goat.redis_connection.set('user', 'token')
+
+        @self.app.route('/all')
+        @self.goat.members_only('team1', 'team2')
+        async def all_teams():
+            return 'ok'
+
+        @self.app.route('/any')
+        @self.goat.members_union('team1', 'team2')
+        def any_team():
+            return 'ok'
+
+        @self.app.route('/policy')
+        @self.goat.members_policy(Team('team1') & ~Team('team2'))
+        async def policy():
+            return 'ok'
+
+    def client(self):
+        c = self.app.test_client()
+        with c.session_transaction() as sess:
+            sess['user'] = 'user'
+        return c
+
+    def test_members_only(self):
+        self.goat.http.transport = github([1, 2])
+        self.assertEqual(self.client().get('/all').status_code, 200)
+        self.goat.http.transport = github([2])
+        self.assertEqual(self.client().get('/all').status_code, 403)
+
+    def test_members_union(self):
+        self.goat.http.transport = github([2])
+        self.assertEqual(self.client().get('/any').status_code, 200)
+        self.goat.http.transport = github([])
+        self.assertEqual(self.client().get('/any').status_code, 403)
+
+    def test_members_policy(self):
+        self.goat.http.transport = github([1])
+        self.assertEqual(self.client().get('/policy').status_code, 200)
+        self.goat.http.transport = github([1, 2])
+        self.assertEqual(self.client().get('/policy').status_code, 403)
+
+    def test_requires_login(self):
+        with self.app.test_client() as c:
+            self.assertEqual(c.get('/all').status_code, 302)
+
+    def test_callback(self):
+        self.goat.http.transport = github([])
+        self.goat.redis_connection.set('abc', '1')
+        with self.app.test_client() as c:
+            c.get('/callback?state=abc&code=123')
+            self.assertEqual(session['user'], 'username')
+
+    def test_loops_released(self):
+        self.goat.http.transport = github([1, 2])
+        for _ in range(5):
+            self.assertEqual(self.client().get('/all').status_code, 200)
+        gc.collect()
+        self.assertEqual(len(self.goat.http._client._values), 0)
+        self.assertEqual(len(self.goat._astorage._values), 0)
+
+    def test_sweep(self):
+        key = self.goat._membership_key('orphan')
+        self.goat.storage.set(key, '{}')
+        with self.app.app_context():
+            self.assertTrue(self.goat.sweep() >= 1)
+        self.assertIsNone(self.goat.storage.get(key))
+
+    def test_refresh(self):
+        app = Flask('asyncrefresh')
+        app.config.update(self.app.config)
+        app.config['GOAT_MEMBERSHIP_TTL'] = 60
+        app.config['GOAT_REFRESH_AHEAD'] = {'margin': 30, 'stale': 600}
+        goat = AsyncGoat(app)
+        goat.http.transport = github([1])
+
+        @app.route('/one')
+        @goat.members_only('team1')
+        async def one():
+            return 'ok'
+
+        # a request served from an entry about to expire makes it hot
+        key = goat._membership_key('user')
+        goat.storage.set(key, dumps({'1': [True, time.time() + 10]}))
+        c = app.test_client()
+        with c.session_transaction() as sess:
+            sess['user'] = 'user'
+        self.assertEqual(c.get('/one').status_code, 200)
+
+        with app.app_context():
+            asyncio.run(goat.refresh())
+        entries = loads(goat.storage.get(key))
+        self.assertTrue(entries['1'][0])
+        self.assertTrue(entries['1'][1] > time.time() + 30)
+        goat.storage.delete([key, Goat.HOT_PREFIX + key])
+
+
+@unittest.skipIf(httpx is None, 'async dependencies are not installed')
+class TestAsyncHTTPClient(unittest.TestCase):
+
+    def test_client_per_loop(self):
+        client = AsyncHTTPClient(transport=github([]))
+        seen = []
+
+        async def call():
+            await client.get('https://api.github.com/user')
+            reused = client.client
+            await client.get('https://api.github.com/user')
+            self.assertIs(client.client, reused)
+            seen.append(reused)
+
+        asyncio.run(call())
+        asyncio.run(call())
+        self.assertIsNot(seen[0], seen[1])
+        # each loop's client is closed when the loop shuts down
+        self.assertTrue(seen[0].is_closed)
+        self.assertTrue(seen[1].is_closed)
+        # and nothing keeps the finished loops alive
+        gc.collect()
+        self.assertEqual(len(client._client._values), 0)
@@ -0,0 +1,46 @@
+import time
+import unittest
+from flask_goat.breaker import CircuitBreaker
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def test_opens_after_failures(self):
+        changes = []
+        breaker = CircuitBreaker(failures=2, reset=60, listener=changes.append)
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        breaker.failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow())
+        self.assertEqual(changes, [CircuitBreaker.OPEN])
+
+        stats = breaker.stats()
+        self.assertEqual(stats['trips'], 1)
+        self.assertTrue(0 < stats['retry_in'] <= 60)
+
+    def test_success_resets_failures(self):
+        breaker = CircuitBreaker(failures=2, reset=60)
+        breaker.failure()
+        breaker.success()
+        breaker.failure()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_half_open_probes(self):
+        breaker = CircuitBreaker(failures=1, reset=0.01, probes=1)
+        breaker.failure()
+        time.sleep(0.02)
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+
+        # a failed probe opens the circuit again
+        breaker.failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        time.sleep(0.02)
+        self.assertTrue(breaker.allow())
+        breaker.success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(breaker.stats()['trips'], 2)
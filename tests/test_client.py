@@ -0,0 +1,50 @@
+import sys
+import unittest
+import subprocess
+from httmock import all_requests, HTTMock, response
+from flask_goat.client import HTTPClient
+
+
+class TestHTTPClient(unittest.TestCase):
+
+    def test_session_is_reused(self):
+        client = HTTPClient()
+        self.assertIs(client.session, client.session)
+
+    def test_session_recreated_after_fork(self):
+        client = HTTPClient()
+        session = client.session
+        client._pid = -1
+        self.assertIsNot(client.session, session)
+
+    def test_requests_imported_on_first_use(self):
+        code = ('import sys, flask_goat; '
+                'print("requests" in sys.modules, "redis" in sys.modules)')
+        out = subprocess.check_output([sys.executable, '-c', code])
+        self.assertEqual(out.split(), [b'False', b'False'])
+
+    def test_adapter_config(self):
+        client = HTTPClient(pool_size=4, retries=2, backoff=0.5)
+        adapter = client.session.get_adapter('https://api.github.com')
+        self.assertEqual(adapter._pool_maxsize, 4)
+        self.assertEqual(adapter.max_retries.total, 2)
+        self.assertEqual(adapter.max_retries.backoff_factor, 0.5)
+
+    def test_default_timeout(self):
+        seen = {}
+
+        @all_requests
+        def response_content(u, request):
+            return response(200, {}, {}, None, 5, request)
+
+        client = HTTPClient(connect_timeout=1, read_timeout=2)
+        original = client.session.request
+
+        def spy(method, url, **kwargs):
+            seen.update(kwargs)
+            return original(method, url, **kwargs)
+
+        client.session.request = spy
+        with HTTMock(response_content):
+            client.get('https://api.github.com/user')
+        self.assertEqual(seen['timeout'], (1, 2))
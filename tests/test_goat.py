@@ -1,8 +1,12 @@
+import hmac
+import time
+import hashlib
+import threading
 import unittest
-from simplejson import dumps
+from simplejson import dumps, loads
 from httmock import all_requests, HTTMock, response
 from flask import Flask, session
-from flask.ext.goat import Goat
+from flask.ext.goat import Goat, Team, GitHubUnavailable
 
 try:
     from urlparse import urlparse
@@ -106,6 +110,111 @@ class TestGoat(unittest.TestCase):
                         params['state']))
                     self.assertTrue('user' in session)
 
+    def _graphql_mock(self, calls, graphql=True):
+
+        @all_requests
+        def response_content(u, request):
+            calls.append(u.path)
+            headers = {'content-type': 'application/json'}
+            if u.path == '/graphql':
+                if not graphql:
+                    content = {'errors': [{'message': 'forbidden'}]}
+                elif 'viewer' in loads(request.body)['query']:
+                    content = {'data': {'viewer': {
+                        'login': 'username',
+                        'organization': {'viewerIsAMember': True}}}}
+                else:
+                    after = loads(request.body)['variables']['after']
+                    content = {'data': {'organization': {'teams': {
+                        'nodes': [{'databaseId': 2 if after else 1}],
+                        'pageInfo': {'hasNextPage': not after,
+                                     'endCursor': 'c1'}}}}}
+            elif u.path == '/user/teams':
+                org = {'login': 'organization'}
+                content = [{'id': 3, 'organization': org}]
+            elif '/members/' in u.path:
+                return response(204, {}, headers, None, 5, request)
+            else:
+                content = {'access_token': 'usertoken', 'login': 'username'}
+            return response(200, content, headers, None, 5, request)
+
+        return response_content
+
+    def _graphql_login(self, calls, graphql=True):
+        self.app.config['GOAT_GRAPHQL'] = True
+        self.app.config['GOAT_USER_TEAMS_TTL'] = 60
+        with HTTMock(self._graphql_mock(calls, graphql)):
+            with self.app.test_client() as c:
+                with self.app.app_context():
+                    self.goat.storage.set('graphqlstate', '1')
+                    c.get('/callback?state=graphqlstate&code=123')
+                    self.assertEqual(session['user'], 'username')
+                    entry = self.goat._user_record('username')['teams']
+                    self.goat.invalidate_membership('username')
+                    return entry['teams']
+
+    def test_cb_graphql(self):
+        calls = []
+        self.assertEqual(self._graphql_login(calls), [1, 2])
+        self.assertEqual(calls, ['/login/oauth/access_token'] +
+                         ['/graphql'] * 3)
+
+    def test_cb_graphql_falls_back(self):
+        calls = []
+        self.assertEqual(self._graphql_login(calls, graphql=False), [3])
+        self.assertTrue('/user' in calls)
+        self.assertTrue('/user/teams' in calls)
+
+    def test_cb_unavailable(self):
+
+        @all_requests
+        def response_content(u, request):
+            headers = {'content-type': 'application/json'}
+            if u.path == '/user/teams':
+                return response(502, {}, headers, None, 5, request)
+            content = {'access_token': 'usertoken', 'login': 'username'}
+            return response(204, content, headers, None, 5, request)
+
+        self.app.config['GOAT_USER_TEAMS_TTL'] = 60
+        with HTTMock(response_content):
+            with self.app.test_client() as c:
+                with self.app.app_context():
+                    self.goat.storage.set('outagestate', '1')
+                    resp = c.get('/callback?state=outagestate&code=123')
+                    self.assertEqual(resp.status_code, 503)
+                    self.assertFalse('user' in session)
+
+    def test_signed_state(self):
+        app = Flask('signedstate')
+        app.secret_key = 'secret'
+        app.config.update(self.app.config)
+        app.config['GOAT_STORAGE'] = {'backend': 'memory'}
+        app.config['GOAT_SIGNED_STATE'] = {'max_age': 60, 'replay': True}
+        goat = Goat(app)
+
+        @app.route('/')
+        def index():
+            return 'index'
+
+        @all_requests
+        def response_content(u, request):
+            headers = {'content-type': 'application/json'}
+            content = {'access_token': 'usertoken', 'login': 'username'}
+            return response(204, content, headers, None, 5, request)
+
+        with app.app_context():
+            url = urlparse(goat._auth_url())
+            state = dict([q.split('=') for q in url.query.split('&')])['state']
+            self.assertEqual(list(goat.storage.scan('*')), [])
+        with HTTMock(response_content):
+            c = app.test_client()
+            resp = c.get('/callback?state={}xx&code=123'.format(state))
+            self.assertEqual(resp.status_code, 403)
+            resp = c.get('/callback?state={}&code=123'.format(state))
+            self.assertEqual(resp.status_code, 302)
+            resp = c.get('/callback?state={}&code=123'.format(state))
+            self.assertEqual(resp.status_code, 403)
+
     def test_get_teams(self):
 
         @all_requests
@@ -116,7 +225,7 @@ class TestGoat(unittest.TestCase):
                 {'name': 'team2', 'id': 2},
             ]
             content = dumps(content).encode('utf-8')
-            return response(204, content, headers, None, 5, request)
+            return response(200, content, headers, None, 5, request)
 
         with HTTMock(response_content):
             with self.app.app_context():
@@ -140,3 +249,855 @@ class TestGoat(unittest.TestCase):
             with self.app.app_context():
                 self.assertTrue(self.goat.is_team_member(
                     'token', 'user', 'team1'))
+
+    def test_membership_cache(self):
+        calls = []
+
+        @all_requests
+        def response_content(u, request):
+            calls.append(u.path)
+            headers = {'content-type': 'application/json'}
+            content = [
+                {'name': 'team1', 'id': 1},
+                {'name': 'team2', 'id': 2},
+            ]
+            content = dumps(content).encode('utf-8')
+            return response(200, content, headers, None, 5, request)
+
+        self.app.config['GOAT_MEMBERSHIP_TTL'] = 60
+        with HTTMock(response_content):
+            with self.app.app_context():
+                self.goat.invalidate_membership('user')
+                self.assertTrue(self.goat.is_team_member(
+                    'token', 'user', 'team1'))
+                self.assertTrue(self.goat.is_team_member(
+                    'token', 'user', 'team1'))
+                self.assertEqual(self.goat.cache_stats['hits'], 1)
+                self.assertEqual(self.goat.cache_stats['misses'], 1)
+                self.assertEqual(
+                    len([p for p in calls if 'memberships' in p]), 1)
+
+    def test_logout_invalidates_membership(self):
+        self.app.config['GOAT_MEMBERSHIP_TTL'] = 60
+        with self.app.test_client() as c:
+            with self.app.app_context():
+                self.goat._cache_membership('user', 1, True)
+                self.assertTrue(self.goat._cached_membership('user', 1))
+            with c.session_transaction() as sess:
+                sess['user'] = 'user'
+            c.get('/logout')
+            with self.app.app_context():
+                self.assertIsNone(self.goat._cached_membership('user', 1))
+
+    def test_local_cache(self):
+        app = Flask('localcache')
+        app.config.update(self.app.config)
+        app.config['GOAT_LOCAL_CACHE'] = {'maxsize': 16, 'ttl': 60}
+        goat = Goat(app)
+        with app.app_context():
+            goat._write('GOAT_TEAMS', dumps({'team1': 1}))
+            goat._write(*goat._teams_marker())
+            self.assertEqual(goat._get_org_teams('token'), {'team1': 1})
+            goat.redis_connection.set('GOAT_TEAMS', dumps({'team2': 2}))
+            self.assertEqual(goat._get_org_teams('token'), {'team1': 1})
+            goat._delete('GOAT_TEAMS')
+            self.assertIsNone(goat.local_cache.get('GOAT_TEAMS'))
+
+    def _team_mock(self, members):
+
+        @all_requests
+        def response_content(u, request):
+            headers = {'content-type': 'application/json'}
+            if '/orgs/' in u.path:
+                content = [
+                    {'name': 'team1', 'id': 1},
+                    {'name': 'team2', 'id': 2},
+                    {'name': 'team3', 'id': 3},
+                ]
+                content = dumps(content).encode('utf-8')
+                return response(200, content, headers, None, 5, request)
+            tid = int(u.path.split('/')[2])
+            code = 200 if tid in members else 404
+            return response(code, {}, headers, None, 5, request)
+
+        return response_content
+
+    def _protected_client(self):
+
+        @self.app.route('/all')
+        @self.goat.members_only('team1', 'team2', 'team3')
+        def all_teams():
+            return 'ok'
+
+        @self.app.route('/any')
+        @self.goat.members_union('team1', 'team2', 'team3')
+        def any_team():
+            return 'ok'
+
+        with self.app.app_context():
+            self.goat._delete('GOAT_TEAMS')
+            self.goat._write('user', 'token')
+        c = self.app.test_client()
+        with c.session_transaction() as sess:
+            sess['user'] = 'user'
+        return c
+
+    def test_members_only_concurrent(self):
+        c = self._protected_client()
+        with HTTMock(self._team_mock([1, 2, 3])):
+            self.assertEqual(c.get('/all').status_code, 200)
+        with HTTMock(self._team_mock([1, 3])):
+            self.assertEqual(c.get('/all').status_code, 403)
+
+    def test_members_union_concurrent(self):
+        c = self._protected_client()
+        with HTTMock(self._team_mock([3])):
+            self.assertEqual(c.get('/any').status_code, 200)
+        with HTTMock(self._team_mock([])):
+            self.assertEqual(c.get('/any').status_code, 403)
+
+    def test_get_user_teams_paginates(self):
+
+        @all_requests
+        def response_content(u, request):
+            org = {'login': 'Organization'}
+            if 'page=2' in u.query:
+                headers = {'content-type': 'application/json'}
+                content = [{'id': 3, 'organization': org}]
+            else:
+                headers = {
+                    'content-type': 'application/json',
+                    'link': '<https://api.github.com/user/teams?page=2>; rel="next"',
+                }
+                content = [
+                    {'id': 1, 'organization': org},
+                    {'id': 2, 'organization': {'login': 'other'}},
+                ]
+            content = dumps(content).encode('utf-8')
+            return response(200, content, headers, None, 5, request)
+
+        with HTTMock(response_content):
+            with self.app.app_context():
+                teams = self.goat.get_user_teams('token')
+                self.assertEqual(teams, set([1, 3]))
+
+    def test_prefetched_teams(self):
+        self.app.config['GOAT_USER_TEAMS_TTL'] = 60
+        c = self._protected_client()
+        with self.app.app_context():
+            self.goat._store_user_teams('user', [1, 3])
+        with HTTMock(self._team_mock([])):
+            self.assertEqual(c.get('/all').status_code, 403)
+            self.assertEqual(c.get('/any').status_code, 200)
+        with self.app.app_context():
+            self.goat.invalidate_membership('user')
+            self.assertIsNone(self.goat._user_record('user')['teams'])
+
+    def test_members_policy(self):
+
+        @self.app.route('/policy')
+        @self.goat.members_policy(Team('team1') | ('team2' & ~Team('team3')))
+        def policy():
+            return 'ok'
+
+        c = self._protected_client()
+        with HTTMock(self._team_mock([2])):
+            self.assertEqual(c.get('/policy').status_code, 200)
+        with HTTMock(self._team_mock([2, 3])):
+            self.assertEqual(c.get('/policy').status_code, 403)
+
+        self.app.config['GOAT_USER_TEAMS_TTL'] = 60
+        with self.app.app_context():
+            self.goat._store_user_teams('user', [1, 3])
+        with HTTMock(self._team_mock([])):
+            self.assertEqual(c.get('/policy').status_code, 200)
+        with self.app.app_context():
+            self.goat.invalidate_membership('user')
+
+    def test_session_claims(self):
+        calls = []
+
+        @all_requests
+        def response_content(u, request):
+            calls.append(u.path)
+            headers = {'content-type': 'application/json'}
+            if u.path == '/user/teams':
+                org = {'login': 'organization'}
+                content = [{'id': 1, 'organization': org}]
+            else:
+                content = [
+                    {'name': 'team1', 'id': 1},
+                    {'name': 'team2', 'id': 2},
+                ]
+            content = dumps(content).encode('utf-8')
+            return response(200, content, headers, None, 5, request)
+
+        @self.app.route('/claim')
+        @self.goat.members_only('team1')
+        def claim():
+            return 'ok'
+
+        @self.app.route('/claim2')
+        @self.goat.members_only('team2')
+        def claim2():
+            return 'ok'
+
+        self.app.config['GOAT_CLAIM_TTL'] = 300
+        c = self._protected_client()
+        with HTTMock(response_content):
+            self.assertEqual(c.get('/claim').status_code, 200)
+            self.assertTrue('/user/teams' in calls)
+            del calls[:]
+            self.assertEqual(c.get('/claim').status_code, 200)
+            self.assertEqual(c.get('/claim2').status_code, 403)
+            self.assertEqual(calls, [])
+
+            # a forged claim is re-validated
+            with c.session_transaction() as sess:
+                sess['goat_claim'] = sess['goat_claim'][:-2] + 'xx'
+            self.assertEqual(c.get('/claim').status_code, 200)
+            self.assertTrue('/user/teams' in calls)
+
+            # a claim issued to another user is ignored
+            with c.session_transaction() as sess:
+                sess['user'] = 'other'
+            with self.app.app_context():
+                self.goat._delete('other')
+            self.assertEqual(c.get('/claim').status_code, 403)
+
+    def test_metrics(self):
+        app = Flask('metrics')
+        app.secret_key = 'secret'
+        app.config.update(self.app.config)
+        app.config['GOAT_METRICS'] = {'endpoint': '/metrics'}
+        goat = Goat(app)
+
+        @app.route('/team')
+        @goat.members_only('team1')
+        def team():
+            return 'ok'
+
+        with app.app_context():
+            goat._delete('GOAT_TEAMS')
+            goat._write('user', 'token')
+        c = app.test_client()
+        with c.session_transaction() as sess:
+            sess['user'] = 'user'
+        with HTTMock(self._team_mock([1])):
+            self.assertEqual(c.get('/team').status_code, 200)
+        with HTTMock(self._team_mock([])):
+            self.assertEqual(c.get('/team').status_code, 403)
+
+        metrics = goat.metrics
+        self.assertEqual(metrics.counter(
+            'goat_decisions_total', view='team', outcome='allow'), 1)
+        self.assertEqual(metrics.counter(
+            'goat_decisions_total', view='team', outcome='deny'), 1)
+        self.assertEqual(metrics.counter(
+            'goat_github_requests_total',
+            endpoint='/teams/{team}/memberships/{user}', status=404), 1)
+        self.assertEqual(metrics.histogram(
+            'goat_decision_seconds', view='team')['count'], 2)
+        self.assertTrue(metrics.histogram(
+            'goat_storage_operation_seconds', op='get')['count'])
+
+        resp = c.get('/metrics')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(b'goat_decisions_total{outcome="deny",view="team"} 1'
+                        in resp.data)
+
+    def test_trace(self):
+        from flask_goat import request_traced
+
+        app = Flask('trace')
+        app.secret_key = 'secret'
+        app.config.update(self.app.config)
+        app.config['GOAT_TRACE'] = True
+        goat = Goat(app)
+
+        @app.route('/')
+        def index():
+            return 'index'
+
+        @app.route('/team')
+        @goat.members_only('team1')
+        def team():
+            return 'ok'
+
+        traces = []
+
+        def traced(sender, trace, response):
+            traces.append(trace)
+
+        with app.app_context():
+            goat._delete('GOAT_TEAMS')
+            goat._write('user', 'token')
+        c = app.test_client()
+        with c.session_transaction() as sess:
+            sess['user'] = 'user'
+        with request_traced.connected_to(traced, app), \
+                HTTMock(self._team_mock([1])):
+            resp = c.get('/team')
+        self.assertEqual(resp.status_code, 200)
+        timing = resp.headers['Server-Timing']
+        for kind in ('auth', 'view', 'github', 'storage'):
+            self.assertTrue('goat-{};dur='.format(kind) in timing)
+        self.assertEqual(len(traces), 1)
+        kinds = set(e[0] for e in traces[0].events)
+        self.assertEqual(kinds, set(['auth', 'view', 'github', 'storage']))
+        self.assertTrue(('github', '/teams/{team}/memberships/{user}')
+                        in [e[:2] for e in traces[0].events])
+
+        # requests that do no authorization work are left alone
+        self.assertFalse('Server-Timing' in c.get('/').headers)
+        self.assertEqual(len(traces), 1)
+        with app.app_context():
+            goat._delete('GOAT_TEAMS')
+            goat.invalidate_membership('user')
+
+    def test_circuit_breaker(self):
+        app = Flask('breaker')
+        app.secret_key = 'secret'
+        app.config.update(self.app.config)
+        app.config['GOAT_MEMBERSHIP_TTL'] = 60
+        app.config['GOAT_METRICS'] = {'endpoint': None}
+        app.config['GOAT_BREAKER'] = {'failures': 1, 'reset': 60}
+        goat = Goat(app)
+
+        @app.route('/team')
+        @goat.members_only('team1')
+        def team():
+            return 'ok'
+
+        @all_requests
+        def down(u, request):
+            return response(502, {}, {}, None, 5, request)
+
+        with app.app_context():
+            goat._delete('GOAT_TEAMS')
+            goat.invalidate_membership('user')
+            goat.invalidate_membership('other')
+            goat._write('user', 'token')
+            goat._write('other', 'token')
+        c = app.test_client()
+        with c.session_transaction() as sess:
+            sess['user'] = 'user'
+        with HTTMock(self._team_mock([1])):
+            self.assertEqual(c.get('/team').status_code, 200)
+
+        # expired decisions are served as last-known-good while GitHub is down
+        with app.app_context():
+            key = goat._membership_key('user')
+            entries = loads(goat.storage.get(key))
+            entries['1'][1] = time.time() - 10
+            goat._write(key, dumps(entries))
+            goat._delete('GOAT_TEAMS_REFRESH')
+        with HTTMock(down):
+            self.assertEqual(c.get('/team').status_code, 200)
+        self.assertEqual(goat.breaker.state, 'open')
+        self.assertEqual(goat.metrics.gauge('goat_breaker_state'), 2)
+
+        # without one the view fails fast instead of asking GitHub
+        rejected = goat.metrics.counter(
+            'goat_github_rejected_total',
+            endpoint='/teams/{team}/memberships/{user}')
+        with c.session_transaction() as sess:
+            sess['user'] = 'other'
+        with HTTMock(down):
+            self.assertEqual(c.get('/team').status_code, 503)
+        self.assertEqual(goat.metrics.counter(
+            'goat_github_rejected_total',
+            endpoint='/teams/{team}/memberships/{user}'), rejected + 1)
+        with app.app_context():
+            goat._delete('GOAT_TEAMS')
+            goat.revoke('user')
+            goat.revoke('other')
+
+    def test_access_matrix(self):
+        calls = []
+
+        @all_requests
+        def response_content(u, request):
+            calls.append(u.path + '?' + u.query)
+            headers = {'content-type': 'application/json'}
+            if '/orgs/' in u.path:
+                content = [
+                    {'name': 'team1', 'id': 1},
+                    {'name': 'team2', 'id': 2},
+                    {'name': 'team3', 'id': 3},
+                ]
+            elif u.path == '/teams/3/members':
+                # a secret team the token may not read
+                return response(404, {}, headers, None, 5, request)
+            elif u.path == '/teams/1/members' and 'page=2' not in u.query:
+                headers['link'] = \
+                    '<https://api.github.com/teams/1/members?page=2>; rel="next"'
+                content = [{'login': 'Alice'}]
+            elif u.path == '/teams/1/members':
+                content = [{'login': 'bob'}]
+            else:
+                content = [{'login': 'bob'}]
+            content = dumps(content).encode('utf-8')
+            return response(200, content, headers, None, 5, request)
+
+        self.app.config['GOAT_MEMBERSHIP_TTL'] = 60
+        self.app.config['GOAT_MEMBERSHIP_NEGATIVE_TTL'] = 60
+        with HTTMock(response_content):
+            with self.app.app_context():
+                self.goat._delete('GOAT_TEAMS')
+                for user in ('alice', 'bob'):
+                    self.goat.invalidate_membership(user)
+                matrix = self.goat.access_matrix(
+                    'token', ['alice', 'bob'],
+                    ['team1', 'team2', 'team3', 'team9'], cache=True)
+                self.assertEqual(matrix, {
+                    'alice': {'team1': True, 'team2': False, 'team3': False,
+                              'team9': False},
+                    'bob': {'team1': True, 'team2': True, 'team3': False,
+                            'team9': False},
+                })
+                members = [c for c in calls if '/members' in c]
+                self.assertEqual(len(members), 4)
+
+                # positives are cached under the login GitHub spells
+                del calls[:]
+                self.assertTrue(self.goat.is_team_member(
+                    'token', 'Alice', 'team1'))
+                self.assertTrue(self.goat.is_team_member(
+                    'token', 'bob', 'team1'))
+                self.assertEqual(calls, [])
+
+                # alice may be a pending member, which the list leaves out
+                self.assertIsNone(self.goat._cached_membership('alice', 2))
+                for user in ('Alice', 'bob'):
+                    self.goat.invalidate_membership(user)
+
+    def test_team_map_pagination_and_etags(self):
+        seen = []
+
+        @all_requests
+        def response_content(u, request):
+            seen.append(request.headers.get('If-None-Match'))
+            if request.headers.get('If-None-Match'):
+                return response(304, None, {}, None, 5, request)
+            headers = {'content-type': 'application/json'}
+            if 'page=2' in u.query:
+                headers['etag'] = '"two"'
+                content = [{'name': 'team2', 'id': 2}]
+            else:
+                headers['etag'] = '"one"'
+                headers['link'] = '<https://api.github.com/orgs/organization/teams?page=2>; rel="next"'
+                content = [{'name': 'team1', 'id': 1}]
+            content = dumps(content).encode('utf-8')
+            return response(200, content, headers, None, 5, request)
+
+        with HTTMock(response_content):
+            with self.app.app_context():
+                self.goat._delete('GOAT_TEAMS_PAGES')
+                self.goat._delete('GOAT_TEAMS_REFRESH')
+                teams = self.goat._get_org_teams('token')
+                self.assertEqual(teams, {'team1': 1, 'team2': 2})
+                self.assertEqual(seen, [None, None])
+
+                self.goat._delete('GOAT_TEAMS_REFRESH')
+                self.goat.redis_connection.set('GOAT_TEAMS', 'untouched')
+                self.goat._refresh_org_teams('token')
+                self.assertEqual(seen[2:], ['"one"', '"two"'])
+                self.assertEqual(
+                    self.goat.redis_connection.get('GOAT_TEAMS'), b'untouched')
+                self.assertTrue(self.goat._read('GOAT_TEAMS_REFRESH'))
+                self.goat._delete('GOAT_TEAMS')
+
+    def test_team_map_error_keeps_old_map(self):
+
+        @all_requests
+        def rate_limited(u, request):
+            content = dumps({'message': 'API rate limit exceeded'})
+            return response(403, content.encode('utf-8'),
+                            {'content-type': 'application/json'},
+                            None, 5, request)
+
+        with self.app.app_context():
+            goat = self.goat
+            goat._write('GOAT_TEAMS', dumps({'team1': 1}))
+            goat._delete('GOAT_TEAMS_REFRESH')
+            with HTTMock(rate_limited):
+                self.assertRaises(GitHubUnavailable,
+                                  goat._refresh_org_teams, 'token')
+                # the last-known map is served instead
+                self.assertEqual(goat._get_org_teams('token'), {'team1': 1})
+            self.assertEqual(loads(goat.storage.get('GOAT_TEAMS')),
+                             {'team1': 1})
+            self.assertIsNone(goat.storage.get('GOAT_TEAMS_REFRESH'))
+
+            goat._delete('GOAT_TEAMS')
+            with HTTMock(rate_limited):
+                self.assertRaises(GitHubUnavailable,
+                                  goat._get_org_teams, 'token')
+            self.assertIsNone(goat.storage.get('GOAT_TEAMS'))
+
+    def test_refresh_ahead(self):
+        app = Flask('refreshahead')
+        app.config.update(self.app.config)
+        app.config['GOAT_MEMBERSHIP_TTL'] = 60
+        app.config['GOAT_REFRESH_AHEAD'] = {'margin': 30, 'stale': 600}
+        goat = Goat(app)
+        worker = Flask('otherworker')
+        worker.config.update(app.config)
+        other = Goat(worker)
+        calls = []
+
+        @all_requests
+        def response_content(u, request):
+            calls.append(u.path)
+            return response(200, {}, {}, None, 5, request)
+
+        with app.app_context():
+            goat.redis_connection.delete('GOAT_REFRESH_LEADER')
+            self.assertTrue(goat._lead())
+            self.assertFalse(other._lead())
+            self.assertTrue(goat._lead())
+
+            goat.invalidate_membership('user')
+            goat._write('user', 'token')
+            entries = {'1': [True, time.time() - 10]}
+            goat._write(goat._membership_key('user'), dumps(entries))
+            self.assertTrue(goat._cached_membership('user', 1))
+
+            # entries nobody read lately are left to expire
+            goat.invalidate_membership('cold')
+            goat._write('cold', 'token')
+            goat._write(goat._membership_key('cold'), dumps(entries))
+
+            with HTTMock(response_content):
+                goat.refresh()
+            self.assertEqual(calls, ['/teams/1/memberships/user'])
+            entries = goat._read(goat._membership_key('user'), loads)
+            self.assertTrue(entries['1'][1] > time.time() + 30)
+            goat.revoke('cold')
+
+    def test_refresh_ahead_stale_team_map(self):
+        app = Flask('staleteams')
+        app.config.update(self.app.config)
+        app.config['GOAT_REFRESH_AHEAD'] = {'stale': 600}
+        goat = Goat(app)
+        calls = []
+
+        @all_requests
+        def response_content(u, request):
+            calls.append(u.path)
+            content = dumps([{'name': 'team2', 'id': 2}]).encode('utf-8')
+            return response(200, content, {}, None, 5, request)
+
+        with app.app_context(), HTTMock(response_content):
+            goat._write('GOAT_TEAMS', dumps({'team1': 1}))
+            goat._write('GOAT_TEAMS_REFRESH', repr(time.time() - 100))
+            self.assertEqual(goat._get_org_teams('token'), {'team1': 1})
+            self.assertEqual(calls, [])
+
+            # past the stale window the map is refreshed inline
+            goat._write('GOAT_TEAMS_REFRESH', repr(time.time() - 700))
+            self.assertEqual(goat._get_org_teams('token'), {'team2': 2})
+            self.assertEqual(len(calls), 1)
+            goat._delete('GOAT_TEAMS')
+            goat._delete('GOAT_TEAMS_PAGES')
+
+    def _webhook_client(self):
+        app = Flask('webhook')
+        app.config.update(self.app.config)
+        app.config['GOAT_WEBHOOK'] = '/github'
+        app.config['GOAT_WEBHOOK_SECRET'] = 'hooksecret'
+        app.config['GOAT_MEMBERSHIP_TTL'] = 60
+        app.config['GOAT_USER_TEAMS_TTL'] = 60
+        goat = Goat(app)
+
+        def post(event, payload, secret=b'hooksecret'):
+            body = dumps(payload).encode('utf-8')
+            digest = hmac.new(secret, body, hashlib.sha256).hexdigest()
+            return app.test_client().post('/github', data=body, headers={
+                'X-GitHub-Event': event,
+                'X-Hub-Signature-256': 'sha256=' + digest,
+            })
+
+        return app, goat, post
+
+    def test_webhook_signature(self):
+        app, goat, post = self._webhook_client()
+        self.assertEqual(post('ping', {}).status_code, 204)
+        self.assertEqual(post('ping', {}, b'wrong').status_code, 403)
+
+    def test_webhook_membership(self):
+        app, goat, post = self._webhook_client()
+        with app.app_context():
+            goat._cache_membership('user', 1, True)
+            goat._cache_membership('user', 2, True)
+            goat._store_user_teams('user', [1, 2])
+            key = goat._membership_key('user')
+            # the key's own TTL is gone, e.g. it was about to expire
+            goat.storage.set(key, goat.storage.get(key))
+
+        def removed(tid):
+            post('membership', {
+                'action': 'removed',
+                'scope': 'team',
+                'member': {'login': 'user'},
+                'team': {'id': tid, 'name': 'team{}'.format(tid)},
+            })
+
+        removed(1)
+        with app.app_context():
+            self.assertIsNone(goat._cached_membership('user', 1))
+            self.assertTrue(goat._cached_membership('user', 2))
+            self.assertIsNotNone(goat.storage.ttl(key))
+            self.assertEqual(goat._user_teams('token', 'user'), set([2]))
+        removed(2)
+        self.assertIsNone(goat.storage.get(key))
+
+    def test_webhook_team_renamed(self):
+        app, goat, post = self._webhook_client()
+        with app.app_context():
+            goat._write('GOAT_TEAMS', dumps({'team1': 1}))
+        post('team', {
+            'action': 'edited',
+            'team': {'id': 1, 'name': 'renamed'},
+            'changes': {'name': {'from': 'team1'}},
+        })
+        with app.app_context():
+            self.assertEqual(goat._read('GOAT_TEAMS', loads), {'renamed': 1})
+            goat._delete('GOAT_TEAMS')
+
+    def test_single_round_trip(self):
+        self.app.config['GOAT_USER_TEAMS_TTL'] = 60
+        c = self._protected_client()
+        with self.app.app_context():
+            self.goat._write('GOAT_TEAMS', dumps({'team1': 1}))
+            self.goat._write(*self.goat._teams_marker())
+            self.goat._store_user_teams('user', [1])
+        calls = []
+        connection = self.goat.redis_connection
+
+        def spy(name):
+            original = getattr(connection, name)
+
+            def wrapped(*args, **kwargs):
+                calls.append(name)
+                return original(*args, **kwargs)
+            setattr(connection, name, wrapped)
+
+        spy('get')
+        spy('mget')
+        try:
+            self.assertEqual(c.get('/any').status_code, 200)
+            # a user without a record costs no extra round-trip either
+            with c.session_transaction() as sess:
+                sess['user'] = 'stranger'
+            c.get('/any')
+        finally:
+            del connection.get, connection.mget
+        self.assertEqual(calls, ['mget', 'mget'])
+
+    def test_redis_sentinel(self):
+        app = Flask('sentinel')
+        app.config.update(self.app.config)
+        app.config['GOAT_REDIS'] = {
+            'method': 'sentinel',
+            'sentinels': [('localhost', 26379)],
+            'service': 'mymaster',
+            'max_connections': 5,
+            'socket_timeout': 0.5,
+        }
+        goat = Goat(app)
+        pool = goat.redis_connection.connection_pool
+        self.assertEqual(pool.service_name, 'mymaster')
+        self.assertEqual(pool.max_connections, 5)
+        self.assertEqual(pool.connection_kwargs['socket_timeout'], 0.5)
+
+    def test_user_keys_share_hash_tag(self):
+        for key in (self.goat._membership_key('alice'),
+                    self.goat._user_key('alice')):
+            self.assertTrue(key.endswith('{alice}'))
+            self.assertEqual(self.goat._key_user(key), 'alice')
+
+    def test_user_records(self):
+        self.app.config['GOAT_USER_TTL'] = 1000
+        with self.app.app_context():
+            goat = self.goat
+            key = goat._user_key('legacy')
+
+            # a bare token from an older release is moved into a record
+            goat.storage.set('legacy', 'oldtoken')
+            self.assertEqual(goat._user_token('legacy'), 'oldtoken')
+            self.assertIsNone(goat.storage.get('legacy'))
+            self.assertTrue(0 < goat.storage.ttl(key) <= 1000)
+
+            # activity slides the expiry once a tenth of it has passed
+            record = goat._user_record('legacy')
+            record['seen'] = time.time() - 200
+            goat._write(*goat._user_write('legacy', record))
+            goat.storage.expire(key, 800)
+            self.assertEqual(goat._active_token('legacy'), 'oldtoken')
+            self.assertTrue(goat.storage.ttl(key) > 800)
+
+            # idle users and orphaned decisions are swept
+            record['seen'] = time.time() - 2000
+            goat._write(*goat._user_write('legacy', record))
+            goat._write(goat._membership_key('legacy'), '{}')
+            goat._write(goat._membership_key('orphan'), '{}')
+            goat._write(*goat._user_write(
+                'active', goat._new_user_record('token')))
+            self.assertTrue(goat.sweep() >= 2)
+            self.assertIsNone(goat.storage.get(key))
+            self.assertIsNone(goat.storage.get(
+                goat._membership_key('orphan')))
+            self.assertEqual(goat._user_token('active'), 'token')
+
+            goat.revoke('active')
+            self.assertIsNone(goat._user_token('active'))
+
+    def test_lazy_fork_safe_state(self):
+        storage = self.goat.storage
+        self.assertIsNone(storage._connection)
+        connection = self.goat.redis_connection
+        self.assertIsNotNone(connection)
+        self.assertIs(self.goat.redis_connection, connection)
+
+        # a forked worker opens its own connection
+        storage._pid = -1
+        self.assertIsNot(self.goat.redis_connection, connection)
+
+        app = Flask('fork')
+        app.config.update(self.app.config)
+        app.config['GOAT_STORAGE'] = {'backend': 'memory'}
+        app.config['GOAT_LOCAL_CACHE'] = {'maxsize': 10, 'ttl': 60}
+        goat = Goat(app)
+        goat._ensure_process()
+        flights = goat._flights
+        goat.local_cache.set('user', 'token')
+        goat._ensure_process()
+        self.assertTrue('user' in goat.local_cache)
+
+        # nor does it keep what its parent cached or had in flight
+        goat._pid = -1
+        goat._ensure_process()
+        self.assertFalse('user' in goat.local_cache)
+        self.assertIsNot(goat._flights, flights)
+
+    def test_memory_storage(self):
+        app = Flask('memory')
+        app.config.update(self.app.config)
+        app.config['GOAT_STORAGE'] = {'backend': 'memory', 'maxsize': 100}
+        goat = Goat(app)
+        self.assertIsNone(goat.redis_connection)
+        with app.app_context():
+            url = urlparse(goat._auth_url())
+            params = dict([q.split('=') for q in url.query.split('&')])
+            self.assertEqual(goat.storage.get(params['state']), b'1')
+
+    def test_invalid_storage(self):
+        app = Flask('invalidstorage')
+        app.config.update(self.app.config)
+        app.config['GOAT_STORAGE'] = {'backend': 'fubar'}
+        self.assertRaises(ValueError, Goat, app)
+
+    def test_rate_limit_budget(self):
+        calls = []
+
+        @all_requests
+        def response_content(u, request):
+            calls.append(u.path)
+            headers = {
+                'X-RateLimit-Limit': '5000',
+                'X-RateLimit-Remaining': '10',
+                'X-RateLimit-Reset': str(int(time.time()) + 600),
+            }
+            return response(200, {}, headers, None, 5, request)
+
+        self.app.config['GOAT_MEMBERSHIP_TTL'] = 60
+        self.app.config['GOAT_RATELIMIT_RESERVE'] = 100
+        with HTTMock(response_content):
+            with self.app.app_context():
+                self.goat._write('GOAT_TEAMS', dumps({'team1': 1}))
+                self.goat._write(*self.goat._teams_marker())
+                self.goat.invalidate_membership('user')
+                self.goat._fetch_membership('budgettoken', 'user', 1)
+                key = self.goat._rate_limit_key('budgettoken')
+                limits = self.goat.rate_limits()
+                self.assertEqual(limits[key.split(':')[1]]['remaining'], 10)
+                self.assertTrue(self.goat._conserving('budgettoken'))
+
+                # an expired decision is served rather than spending budget
+                entries = {'1': [True, time.time() - 120]}
+                self.goat._write(
+                    self.goat._membership_key('user'), dumps(entries))
+                del calls[:]
+                self.assertTrue(self.goat.is_team_member(
+                    'budgettoken', 'user', 'team1'))
+                self.assertEqual(calls, [])
+
+    def test_rate_limit_writes(self):
+        self.app.config['GOAT_RATELIMIT_RESERVE'] = 100
+        reset = int(time.time()) + 600
+
+        def stored():
+            raw = self.goat.storage.get(key)
+            return loads(raw)['remaining'] if raw else None
+
+        with self.app.app_context():
+            key = self.goat._rate_limit_key('writetoken')
+            for remaining in (500, 400):
+                self.goat._record_rate_limit('writetoken', {
+                    'remaining': remaining, 'limit': 5000, 'reset': reset})
+            self.assertEqual(stored(), 500)
+            self.assertFalse(self.goat._conserving('writetoken'))
+
+            # crossing the reserve is shared right away
+            self.goat._record_rate_limit('writetoken', {
+                'remaining': 50, 'limit': 5000, 'reset': reset})
+            self.assertEqual(stored(), 50)
+            self.assertTrue(self.goat._conserving('writetoken'))
+            self.goat.storage.delete([key])
+
+    def test_coalesce_waits_for_other_worker(self):
+        calls = []
+
+        @all_requests
+        def response_content(u, request):
+            calls.append(u.path)
+            return response(404, {}, {}, None, 5, request)
+
+        self.app.config['GOAT_MEMBERSHIP_TTL'] = 60
+        self.app.config['GOAT_COALESCE'] = {'lock': 10, 'wait': 1}
+        with HTTMock(response_content):
+            with self.app.app_context():
+                self.goat._write('GOAT_TEAMS', dumps({'team1': 1}))
+                self.goat._write(*self.goat._teams_marker())
+                self.goat.invalidate_membership('user')
+                key = self.goat._membership_key('user')
+                lock = 'GOAT_LOCK:{}:1'.format(key)
+                self.goat.storage.add(lock, 'other', 10)
+
+                # another worker stores its answer while we wait
+                entries = dumps({'1': [True, time.time()]})
+                timer = threading.Timer(
+                    0.1, self.goat.storage.set, (key, entries))
+                timer.start()
+                self.assertTrue(self.goat.is_team_member(
+                    'token', 'user', 'team1'))
+                timer.join()
+                self.assertEqual(calls, [])
+
+                # the wait runs out: serve the last-known decision
+                entries = dumps({'1': [True, time.time() - 120]})
+                self.goat.storage.set(key, entries)
+                self.app.config['GOAT_COALESCE'] = {'lock': 10, 'wait': 0.1}
+                self.assertTrue(self.goat.is_team_member(
+                    'token', 'user', 'team1'))
+                self.assertEqual(calls, [])
+
+                # nothing would be stored to wait for: fetch straight away
+                self.app.config['GOAT_MEMBERSHIP_TTL'] = 0
+                self.assertFalse(self.goat.is_team_member(
+                    'token', 'user', 'team1'))
+                self.assertEqual(calls, ['/teams/1/memberships/user'])
+                self.goat.storage.delete(
+                    [lock, 'GOAT_TEAMS', 'GOAT_TEAMS_REFRESH'])
@@ -0,0 +1,61 @@
+import unittest
+from flask_goat.metrics import Metrics, MeteredStorage, endpoint
+from flask_goat.storage import MemoryStorage
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_counters(self):
+        metrics = Metrics()
+        metrics.inc('requests_total', view='a')
+        metrics.inc('requests_total', 2, view='a')
+        self.assertEqual(metrics.counter('requests_total', view='a'), 3)
+        self.assertEqual(metrics.counter('requests_total', view='b'), 0)
+
+    def test_histograms(self):
+        metrics = Metrics(buckets=[0.1, 1])
+        metrics.observe('seconds', 0.05)
+        metrics.observe('seconds', 0.5)
+        metrics.observe('seconds', 5)
+        hist = metrics.histogram('seconds')
+        self.assertEqual(hist['count'], 3)
+        self.assertAlmostEqual(hist['sum'], 5.55)
+        self.assertEqual(hist['buckets'], {0.1: 1, 1: 2})
+
+    def test_render(self):
+        metrics = Metrics(buckets=[1])
+        metrics.inc('requests_total', view='a"b')
+        metrics.set('state', 2)
+        with metrics.timer('seconds', op='get'):
+            pass
+        lines = metrics.render().splitlines()
+        self.assertEqual(metrics.gauge('state'), 2)
+        self.assertTrue('# TYPE state gauge' in lines)
+        self.assertTrue('state 2' in lines)
+        self.assertTrue('# TYPE requests_total counter' in lines)
+        self.assertTrue('requests_total{view="a\\"b"} 1' in lines)
+        self.assertTrue('# TYPE seconds histogram' in lines)
+        self.assertTrue('seconds_bucket{op="get",le="1.0"} 1' in lines)
+        self.assertTrue('seconds_bucket{op="get",le="+Inf"} 1' in lines)
+        self.assertTrue('seconds_count{op="get"} 1' in lines)
+
+    def test_endpoint(self):
+        self.assertEqual(
+            endpoint('https://api.github.com/teams/12/memberships/alice?a=b'),
+            '/teams/{team}/memberships/{user}')
+        self.assertEqual(
+            endpoint('https://api.github.com/orgs/acme/teams?page=2'),
+            '/orgs/{org}/teams')
+        self.assertEqual(endpoint('https://api.github.com/user/teams'),
+                         '/user/teams')
+
+    def test_metered_storage(self):
+        metrics = Metrics()
+        storage = MeteredStorage(MemoryStorage(), metrics)
+        storage.set('a', '1')
+        self.assertEqual(storage.get('a'), b'1')
+        self.assertFalse(storage.broadcasts)
+        self.assertEqual(storage.maxsize, 10000)
+        self.assertEqual(
+            metrics.histogram('goat_storage_operation_seconds',
+                              op='get')['count'], 1)
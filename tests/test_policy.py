@@ -0,0 +1,48 @@
+import unittest
+from flask_goat.policy import Team, CompiledPolicy
+
+
+class TestPolicy(unittest.TestCase):
+
+    def setUp(self):
+        self.policy = CompiledPolicy(
+            Team('Owners') | ('ReadWrite' & ~Team('Contractors')))
+        self.org_teams = {'Owners': 1, 'ReadWrite': 2, 'Contractors': 3}
+
+    def allows(self, team_ids):
+        return self.policy.allows(self.policy.mask(self.org_teams, team_ids))
+
+    def test_teams_in_order(self):
+        self.assertEqual(self.policy.teams,
+                         ('Owners', 'ReadWrite', 'Contractors'))
+
+    def test_truth_table(self):
+        self.assertTrue(self.allows(set([1])))
+        self.assertTrue(self.allows(set([1, 3])))
+        self.assertTrue(self.allows(set([2])))
+        self.assertFalse(self.allows(set([2, 3])))
+        self.assertFalse(self.allows(set([3])))
+        self.assertFalse(self.allows(set()))
+
+    def test_missing_team_is_not_held(self):
+        self.org_teams = {'ReadWrite': 2}
+        self.assertTrue(self.allows(set([2, 3])))
+        self.assertFalse(self.allows(set([1])))
+
+    def test_ids_bound_per_team_map(self):
+        ids = self.policy.ids(self.org_teams)
+        self.assertIs(self.policy.ids(self.org_teams), ids)
+        self.assertEqual(self.policy.ids({'Owners': 4}), (4, None, None))
+
+    def test_large_policies_evaluate_the_tree(self):
+        names = ['team{}'.format(i) for i in range(20)]
+        policy = Team(names[0])
+        for name in names[1:]:
+            policy = policy & name
+        compiled = CompiledPolicy(policy)
+        self.assertIsNone(compiled.table)
+        self.assertTrue(compiled.allows((1 << 20) - 1))
+        self.assertFalse(compiled.allows((1 << 19) - 1))
+
+    def test_invalid_operand(self):
+        self.assertRaises(TypeError, lambda: Team('a') & 1)
@@ -0,0 +1,152 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import redis
+from redis.cluster import block_pipeline_command
+from redis.exceptions import RedisClusterException
+from flask_goat.storage import MemoryStorage, RedisStorage, SQLiteStorage
+
+
+class StorageContract(object):
+
+    def test_get_set(self):
+        self.storage.set('a', 'value')
+        self.assertEqual(self.storage.get('a'), b'value')
+        self.assertIsNone(self.storage.get('missing'))
+
+    def test_get_many(self):
+        self.storage.set_many([('a', '1', None), ('b', 2, None)])
+        self.assertEqual(self.storage.get_many(['a', 'x', 'b']),
+                         [b'1', None, b'2'])
+
+    def test_expiry(self):
+        self.storage.set('a', '1', 0.01)
+        self.assertTrue(self.storage.ttl('a') is not None)
+        time.sleep(0.02)
+        self.assertIsNone(self.storage.get('a'))
+        self.assertEqual(self.storage.ttl('a'), 0)
+
+    def test_ttl(self):
+        self.storage.set('a', '1')
+        self.assertIsNone(self.storage.ttl('a'))
+        self.storage.expire('a', 60)
+        self.assertTrue(0 < self.storage.ttl('a') <= 60)
+
+    def test_delete(self):
+        self.storage.set_many([('a', '1', None), ('b', '2', None)])
+        self.storage.delete(['a', 'b'])
+        self.assertEqual(self.storage.get_many(['a', 'b']), [None, None])
+
+    def test_add(self):
+        self.assertTrue(self.storage.add('lock', 'one', 60))
+        self.assertFalse(self.storage.add('lock', 'two', 60))
+        self.assertEqual(self.storage.get('lock'), b'one')
+
+    def test_scan(self):
+        self.storage.set_many([
+            ('GOAT_MEMBERSHIP:{a}', '1', None),
+            ('GOAT_MEMBERSHIP:{b}', '1', None),
+            ('GOAT_TEAMS', '1', None),
+        ])
+        self.assertEqual(sorted(self.storage.scan('GOAT_MEMBERSHIP:*')),
+                         ['GOAT_MEMBERSHIP:{a}', 'GOAT_MEMBERSHIP:{b}'])
+
+
+class TestMemoryStorage(StorageContract, unittest.TestCase):
+
+    def setUp(self):
+        self.storage = MemoryStorage()
+
+    def test_bounded(self):
+        storage = MemoryStorage(maxsize=2)
+        storage.set('a', '1')
+        storage.set('b', '2')
+        storage.get('a')
+        storage.set('c', '3')
+        self.assertEqual(storage.get_many(['a', 'b', 'c']),
+                         [b'1', None, b'3'])
+
+
+class TestSQLiteStorage(StorageContract, unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.storage = SQLiteStorage(os.path.join(self.tmp, 'goat.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+
+class ClusterPipeline(object):
+
+    """Refuses what a RedisCluster pipeline refuses."""
+
+    publish = block_pipeline_command('PUBLISH')
+
+    def __init__(self, pipe):
+        self.pipe = pipe
+
+    def __getattr__(self, name):
+        return getattr(self.pipe, name)
+
+    def delete(self, *keys):
+        if len(keys) > 1:
+            raise RedisClusterException('keys span several slots')
+        self.pipe.delete(*keys)
+
+
+class Cluster(object):
+
+    """A single Redis server standing in for a RedisCluster."""
+
+    def __init__(self):
+        self.node = redis.Redis()
+
+    def __getattr__(self, name):
+        return getattr(self.node, name)
+
+    def pipeline(self, transaction=True):
+        return ClusterPipeline(self.node.pipeline(transaction=transaction))
+
+    def get_default_node(self):
+        return 'node'
+
+    def get_redis_connection(self, node):
+        return self.node
+
+
+class TestRedisClusterStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = RedisStorage(Cluster())
+        self.pubsub = self.storage.connection.pubsub(
+            ignore_subscribe_messages=True)
+        self.pubsub.subscribe('evict')
+        self.pubsub.get_message(timeout=1)  # the confirmation
+
+    def tearDown(self):
+        self.pubsub.close()
+
+    def announced(self):
+        keys = []
+        message = self.pubsub.get_message(timeout=1)
+        while message is not None:
+            keys.append(message['data'])
+            message = self.pubsub.get_message(timeout=0.1)
+        return keys
+
+    def test_set_many(self):
+        self.storage.set_many([('{a}', '1', None), ('{b}', '2', None)],
+                              'evict')
+        self.assertEqual(self.storage.get_many(['{a}', '{b}']),
+                         [b'1', b'2'])
+        self.assertEqual(self.announced(), [b'{a}', b'{b}'])
+
+    def test_delete(self):
+        self.storage.set_many([('{a}', '1', None), ('{b}', '2', None)])
+        self.storage.delete(['{a}', '{b}'], 'evict')
+        self.assertEqual(self.storage.get_many(['{a}', '{b}']),
+                         [None, None])
+        self.assertEqual(self.announced(), [b'{a}', b'{b}'])
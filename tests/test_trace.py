@@ -0,0 +1,41 @@
+import unittest
+from flask import Flask, g
+from flask_goat.metrics import Metrics
+from flask_goat.trace import Trace, TracingMetrics
+
+
+class TestTrace(unittest.TestCase):
+
+    def test_server_timing(self):
+        trace = Trace()
+        self.assertEqual(trace.server_timing(), '')
+        trace.add('storage', 'get', 0.002)
+        trace.add('storage', 'get_many', 0.001)
+        trace.add('github', '/user', 0.25)
+        trace.add('cache', 'local', 'hit')
+        trace.add('cache', 'membership', 'miss')
+        self.assertEqual(trace.totals()['storage'][0], 2)
+        self.assertEqual(trace.cache_results(), (1, 1))
+        self.assertEqual(
+            trace.server_timing(),
+            'goat-github;dur=250.000;desc="1 call", '
+            'goat-storage;dur=3.000;desc="2 calls", '
+            'goat-cache;desc="1 hits, 1 misses"')
+
+    def test_tracing_metrics(self):
+        metrics = Metrics()
+        tracing = TracingMetrics(metrics)
+
+        # outside a traced request only the metrics are recorded
+        tracing.inc('goat_cache_total', cache='local', result='hit')
+        app = Flask(__name__)
+        with app.app_context():
+            g.goat_trace = Trace()
+            tracing.inc('goat_cache_total', cache='local', result='miss')
+            tracing.observe('goat_storage_operation_seconds', 0.5, op='get')
+            tracing.observe('other_seconds', 0.5)
+            self.assertEqual(g.goat_trace.events, [
+                ('cache', 'local', 'miss'), ('storage', 'get', 0.5)])
+        self.assertEqual(tracing.counter(
+            'goat_cache_total', cache='local', result='hit'), 1)
+        self.assertEqual(metrics.histogram('other_seconds')['count'], 1)